@@ -0,0 +1,125 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import matplotlib
+matplotlib.use('Agg')   # plots are written to files, also from worker processes without a display
+import matplotlib.pyplot as plt
+import pandas as pd
+import data_utils
+from data_utils import load_data
+
+ANALYTICS_COLUMNS = ['city', 'date', 'tavg', 'tmin', 'tmax']
+
+
+def compute_statistics(df: pd.DataFrame, window: int = 30, threshold: float = 2.5) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Per-city statistics of every city in df, each computed in one vectorized groupby pass.
+
+    Returns
+    - summary: one row per city with the day count, period, mean/std of tavg, record tmin/tmax
+      and the number of extreme days
+    - climatology: one row per (city, month) with the long-term means of tavg/tmin/tmax
+    - extremes: the days whose tavg is at least threshold standard deviations away from the
+      city's climatology for that month, with the anomaly, z-score and window-day rolling mean
+    """
+    df = df[ANALYTICS_COLUMNS].copy()
+    # Cast before sorting: a categorical city sorts by its category order, not by name
+    df['city'] = df['city'].astype(str)
+    df = df.sort_values(['city', 'date'], kind='stable').reset_index(drop=True)
+    df['city'] = df['city'].astype('category')
+    by_city = df.groupby('city', observed=True)
+
+    summary = by_city.agg(days=('date', 'size'), first_day=('date', 'min'), last_day=('date', 'max'),
+                          tavg_mean=('tavg', 'mean'), tavg_std=('tavg', 'std'),
+                          record_tmin=('tmin', 'min'), record_tmax=('tmax', 'max'))
+
+    by_month = df.groupby([df['city'], df['date'].dt.month.rename('month')], observed=True)
+    climatology = by_month.agg(tavg_mean=('tavg', 'mean'), tavg_std=('tavg', 'std'),
+                               tmin_mean=('tmin', 'mean'), tmax_mean=('tmax', 'mean'))
+
+    # Anomalies against the city's normal for the calendar month
+    df['anomaly'] = df['tavg'] - by_month['tavg'].transform('mean')
+    df['zscore'] = df['anomaly'] / by_month['tavg'].transform('std')
+    df['rolling_tavg'] = rolling_mean(df, window)
+
+    extremes = df.loc[df['zscore'].abs() >= threshold].reset_index(drop=True)
+    summary['extreme_days'] = extremes.groupby('city', observed=True).size().reindex(summary.index, fill_value=0)
+    return summary, climatology, extremes
+
+
+def rolling_mean(df: pd.DataFrame, window: int) -> pd.Series:
+    """Calendar rolling mean of tavg over window days per city, df must be sorted by date within each city."""
+    # transform returns the rows in df's order, whatever order the groupby visits the cities in
+    rolled = df.set_index('date').groupby('city', observed=True)['tavg'].transform(
+        lambda tavg: tavg.rolling(f'{window}D', min_periods=1).mean())
+    return pd.Series(rolled.to_numpy(), index=df.index)
+
+
+def plot_path(out_dir: str, city: str) -> str:
+    return os.path.join(out_dir, re.sub(r'[^\w-]+', '_', city) + '.png')
+
+
+def plot_city(city: str, city_df: pd.DataFrame, extremes: pd.DataFrame, out_dir: str, window: int = 30) -> str:
+    """Write the city's tavg series, its rolling mean and its extreme days to <out_dir>/<city>.png."""
+    series = city_df.sort_values('date').set_index('date')['tavg']
+    figure, axes = plt.subplots(figsize=(12, 6))
+    axes.plot(series.index, series.to_numpy(), linewidth=0.5, color='tab:blue', label='tavg')
+    axes.plot(series.index, series.rolling(f'{window}D', min_periods=1).mean().to_numpy(),
+              linewidth=1.5, color='tab:orange', label=f'{window}-day mean')
+    axes.scatter(extremes['date'], extremes['tavg'], s=12, color='red', label='extreme days', zorder=3)
+    axes.set_title(f'Temperature Trends in {city}')
+    axes.set_xlabel('Date')
+    axes.set_ylabel('Temperature (°C)')
+    axes.legend()
+    figure.autofmt_xdate()
+    path = plot_path(out_dir, city)
+    figure.savefig(path, dpi=100)
+    plt.close(figure)
+    return path
+
+
+def city_report(filepath: str, city: str, plot_dir: str, window: int, threshold: float, plots: bool):
+    """Statistics and plot of one city, reading only its partition of the Arrow cache."""
+    df = load_data(filepath, columns=ANALYTICS_COLUMNS, cities=[city])
+    summary, climatology, extremes = compute_statistics(df, window, threshold)
+    if plots:
+        plot_city(city, df, extremes, plot_dir, window)
+    return summary, climatology, extremes
+
+
+def run_report(filepath: str, out_dir: str, workers: int = None, window: int = 30, threshold: float = 2.5,
+               plots: bool = True) -> pd.DataFrame:
+    """Write summary.csv, climatology.csv, extremes.csv and plots/<city>.png for every city of the dataset.
+
+    With several workers and the Arrow cache available, cities are fanned out across a process pool,
+    each worker reading only its own city partitions. Otherwise all cities are computed in one pass
+    and only the plots are spread over the pool.
+    """
+    workers = workers or os.cpu_count()
+    plot_dir = os.path.join(out_dir, 'plots')
+    os.makedirs(plot_dir, exist_ok=True)
+
+    if workers > 1 and data_utils.pa is not None:
+        data_utils.ensure_cache(filepath)   # built once here, the workers only read it
+        cities = sorted(load_data(filepath, columns=['city'])['city'].astype(str).unique())
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(city_report, repeat(filepath), cities, repeat(plot_dir), repeat(window),
+                                    repeat(threshold), repeat(plots), chunksize=max(1, len(cities) // (workers * 4))))
+        summary, climatology, extremes = (pd.concat([result[part] for result in results]) for part in range(3))
+    else:
+        df = load_data(filepath, columns=ANALYTICS_COLUMNS)
+        summary, climatology, extremes = compute_statistics(df, window, threshold)
+        if plots:
+            groups = [(str(city), city_df, extremes[extremes['city'] == city])
+                      for city, city_df in df.groupby('city', observed=True)]
+            arguments = [[group[part] for group in groups] for part in range(3)]
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    list(pool.map(plot_city, *arguments, repeat(plot_dir), repeat(window)))
+            else:
+                list(map(plot_city, *arguments, repeat(plot_dir), repeat(window)))
+
+    summary.to_csv(os.path.join(out_dir, 'summary.csv'))
+    climatology.to_csv(os.path.join(out_dir, 'climatology.csv'))
+    extremes.to_csv(os.path.join(out_dir, 'extremes.csv'), index=False)
+    return summary
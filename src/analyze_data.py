@@ -1,33 +1,43 @@
+import os
 import pandas as pd
-import matplotlib.pyplot as plt
 import pprint
-import seaborn as sns
-from data_utils import load_data
+from datetime import datetime
+from data_utils import load_data, load_data_chunks, CHUNK_SIZE
+from db_utils import create_connection
+from query_database import SERIES_RESOLUTIONS, query_date_range, query_temperature_series, series_resolution, lttb
 import argparse
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Analyze .csv file")
-    parser.add_argument("filename", help="The name of the file to process")
-    args = parser.parse_args()
+def load_city_series(db_file: str, city: str, resolution: str = 'auto', max_points: int = 2000, points: int = None) -> pd.DataFrame:
+    """A city's whole series from the database, downsampled on the database side to a bounded number of rows."""
+    connection = create_connection(db_file)
+    try:
+        span = query_date_range(city, connection)
+        if span is None:
+            return pd.DataFrame(columns=['date', 'tavg', 'tmin', 'tmax'])
+        date_from, date_to = (datetime.combine(day, datetime.min.time()) for day in span)
+        if resolution == 'auto' and points is None:
+            resolution = series_resolution(date_from, date_to, max_points)
+            if resolution is None:
+                points = max_points
+        if points is not None:
+            rows = lttb(query_temperature_series(city, date_from, date_to, connection), points)
+        else:
+            rows = query_temperature_series(city, date_from, date_to, connection, resolution)
+    finally:
+        connection.close()
+    city_data = pd.DataFrame(rows, columns=['date', 'tavg', 'tmin', 'tmax'])
+    city_data['date'] = pd.to_datetime(city_data['date'])
+    return city_data
 
-    df = load_data(args.filename)
 
-    pp = pprint.PrettyPrinter(indent=4)
-
-    unique_cities = df['city'].unique().tolist()
-    print('Available cities in the dataset:')
-    for city in unique_cities:
-        print(f'- {city}')
-
-    city_counts = df['city'].value_counts().to_dict()
-    pp.pprint(f'Number of records per city: {city_counts}') 
-
-    num_unique_cities = df['city'].nunique()
-    pp.pprint(f'Number of unique cities: {num_unique_cities}')
-
-    city_name = 'Belgrade'
-    city_data = df[df['city'] == city_name]
+def plot_city_data(city_data: pd.DataFrame, city_name: str, out_dir: str) -> None:
+    """Line and scatter plot of the city's tavg, written to <out_dir>/<city>_{lineplot,scatterplot}.png."""
+    # matplotlib and seaborn take most of the startup time, so they are only imported when plotting
+    import matplotlib
+    matplotlib.use('Agg')   # plots are written to files instead of opened in a window
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
     plt.figure(figsize=(12, 6))
     sns.lineplot(x=city_data['date'], y=city_data['tavg'], label=city_name)
@@ -36,7 +46,8 @@ if __name__ == '__main__':
     plt.xlabel('Date')
     plt.ylabel('Temperature (°C)')
     plt.legend()
-    plt.show()
+    plt.savefig(os.path.join(out_dir, f'{city_name}_lineplot.png'))
+    plt.close()
 
     plt.figure(figsize=(12, 6))
     sns.scatterplot(x=city_data['date'], y=city_data['tavg'], label=city_name, color='red')
@@ -45,4 +56,69 @@ if __name__ == '__main__':
     plt.xlabel('Date')
     plt.ylabel('Temperature (°C)')
     plt.legend()
-    plt.show()
+    plt.savefig(os.path.join(out_dir, f'{city_name}_scatterplot.png'))
+    plt.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Analyze .csv file")
+    parser.add_argument("filename", help="The name of the file to process")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Number of CSV rows parsed at a time")
+    parser.add_argument("--no-cache", action="store_true", help="Stream the CSV instead of reading the columnar cache")
+    parser.add_argument("--db", help="Plot from this database built by build_database.py instead of the CSV")
+    parser.add_argument("--resolution", choices=('auto', *SERIES_RESOLUTIONS), default='auto', help="Aggregation of the plotted series read with --db")
+    parser.add_argument("--max-points", type=int, default=2000, help="Row budget of --resolution auto")
+    parser.add_argument("--points", type=int, help="Plot this many LTTB-selected days read with --db instead")
+    parser.add_argument("--out", default="plots", help="Directory the plots are written to")
+    parser.add_argument("--report", action="store_true", help="Write statistics and plots of every city to --out")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes used by --report")
+    parser.add_argument("--window", type=int, default=30, help="Days of the rolling mean in --report")
+    parser.add_argument("--threshold", type=float, default=2.5, help="Standard deviations from the monthly normal that make an extreme day")
+    parser.add_argument("--list-cities", action="store_true", help="Only list the cities and their record counts, without plotting")
+    args = parser.parse_args()
+    if args.max_points < 3 or (args.points is not None and args.points < 3):
+        parser.error("--max-points and --points must be at least 3")
+
+    if args.report:
+        from analytics import run_report
+        summary = run_report(args.filename, args.out, args.workers, args.window, args.threshold)
+        print(summary.to_string())
+        print(f"Wrote statistics of {len(summary)} cities and their plots to {args.out}")
+        raise SystemExit(0)
+
+    city_name = 'Belgrade'
+    plot = not args.list_cities
+
+    if args.no_cache:
+        # Stream the CSV: only the per-city counts and the plotted city's rows are kept in memory
+        city_counts = pd.Series(dtype='int64')
+        city_parts = []
+        for chunk in load_data_chunks(args.filename, args.chunk_size, use_cache=False):
+            city_counts = city_counts.add(chunk['city'].value_counts(sort=False).astype('int64'), fill_value=0)
+            if plot:
+                city_parts.append(chunk.loc[chunk['city'] == city_name, ['date', 'tavg']])
+        city_counts = city_counts[city_counts > 0].astype('int64')
+        city_data = pd.concat(city_parts, ignore_index=True) if plot else None
+    else:
+        # Read only the columns and the city partition that are actually used from the columnar cache
+        city_counts = load_data(args.filename, columns=['city'])['city'].value_counts()
+        city_counts = city_counts[city_counts > 0].sort_index()
+        city_data = None if args.db or not plot else load_data(args.filename, columns=['date', 'tavg'], cities=[city_name])
+    if args.db and plot:
+        city_data = load_city_series(args.db, city_name, args.resolution, args.max_points, args.points)
+
+    pp = pprint.PrettyPrinter(indent=4)
+
+    unique_cities = city_counts.index.tolist()
+    print('Available cities in the dataset:')
+    for city in unique_cities:
+        print(f'- {city}')
+
+    pp.pprint(f'Number of records per city: {city_counts.sort_values(ascending=False).to_dict()}') 
+
+    num_unique_cities = len(city_counts)
+    pp.pprint(f'Number of unique cities: {num_unique_cities}')
+
+    if plot:
+        os.makedirs(args.out, exist_ok=True)
+        plot_city_data(city_data, city_name, args.out)
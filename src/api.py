@@ -0,0 +1,176 @@
+import json
+from datetime import datetime
+from flask import Blueprint, current_app, jsonify, request, abort, stream_with_context
+from werkzeug.exceptions import HTTPException
+from query_database import (TemperatureRequest, SERIES_RESOLUTIONS, query_temperature_in_city,
+                            query_max_temperature_in_time_span_per_city, query_min_temperature_in_time_span_per_city,
+                            query_temperature_series, iter_temperature_series, series_resolution, lttb,
+                            query_temperatures_batch)
+from metrics import DB_SECONDS
+
+# JSON endpoints that answer straight from the database, without the LLM. Register on a Flask app with
+#   app.extensions['db_pool'] = ConnectionPool('weather.db')
+#   app.register_blueprint(api)
+# e.g. GET /api/temp?city=Belgrade&date=2020-10-01, GET /api/max?city=Paris&from=2022-02-01&to=2022-02-05
+api = Blueprint('api', __name__, url_prefix='/api')
+
+DATE_FORMATS = ('%Y-%m-%d', '%d-%m-%Y')
+BATCH_TYPES = {'temp': 'daily', 'max': 'max_span', 'min': 'min_span'}
+MAX_BATCH_SIZE = 10_000
+MAX_SERIES_POINTS = 2000
+SERIES_COLUMNS = ['date', 'avg', 'min', 'max']
+
+
+def parse_date(value, name: str) -> datetime:
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except (TypeError, ValueError):
+            pass
+    abort(400, f"'{name}' must be a date in YYYY-MM-DD or DD-MM-YYYY format")
+
+
+def required(values: dict, name: str) -> str:
+    value = values.get(name)
+    if not value:
+        abort(400, f"'{name}' is required")
+    # JSON bodies can carry any type where the query string only has strings
+    if not isinstance(value, str):
+        abort(400, f"'{name}' must be a string")
+    return value
+
+
+def date_range(values: dict) -> tuple[datetime, datetime]:
+    date_from, date_to = parse_date(required(values, 'from'), 'from'), parse_date(required(values, 'to'), 'to')
+    if date_from > date_to:
+        abort(400, "'from' must not be after 'to'")
+    return date_from, date_to
+
+
+def cacheable(payload: dict):
+    """JSON response with an ETag, a repeated request with If-None-Match gets an empty 304."""
+    response = jsonify(payload)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get('API_MAX_AGE', 3600)
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def run_query(func, *args, **kwargs):
+    with current_app.extensions['db_pool'].connection() as connection, DB_SECONDS.time(query=func.__name__):
+        return func(*args, connection=connection, **kwargs)
+
+
+@api.errorhandler(HTTPException)
+def json_error(error: HTTPException):
+    return jsonify(error=error.description), error.code
+
+
+@api.get('/temp')
+def temperature():
+    city, date = required(request.args, 'city'), parse_date(required(request.args, 'date'), 'date')
+    value = run_query(query_temperature_in_city, city, date)
+    if value is None:
+        abort(404, f"No data available for {city} on {date:%Y-%m-%d}")
+    return cacheable({'city': city, 'date': f'{date:%Y-%m-%d}', 'temperature': value})
+
+
+def span_extreme(func):
+    city = required(request.args, 'city')
+    date_from, date_to = date_range(request.args)
+    value = run_query(func, city, date_from, date_to)
+    if value is None:
+        abort(404, f"No data available for {city} from {date_from:%Y-%m-%d} to {date_to:%Y-%m-%d}")
+    return cacheable({'city': city, 'from': f'{date_from:%Y-%m-%d}', 'to': f'{date_to:%Y-%m-%d}', 'temperature': value})
+
+
+@api.get('/max')
+def max_temperature():
+    return span_extreme(query_max_temperature_in_time_span_per_city)
+
+
+@api.get('/min')
+def min_temperature():
+    return span_extreme(query_min_temperature_in_time_span_per_city)
+
+
+@api.get('/series')
+def series():
+    """A city's series over a date range, downsampled so long ranges stay within a bounded number of points.
+
+    resolution is daily, weekly, monthly or auto (default, the finest one within max_points rows, LTTB
+    when even monthly rows exceed it); points=N instead picks N representative days with LTTB.
+    An explicit daily resolution is streamed.
+    """
+    city = required(request.args, 'city')
+    date_from, date_to = date_range(request.args)
+    resolution = request.args.get('resolution', 'auto')
+    if resolution not in ('auto', *SERIES_RESOLUTIONS):
+        abort(400, f"'resolution' must be one of auto, {', '.join(SERIES_RESOLUTIONS)}")
+    points = positive_int(request.args, 'points', None)
+    header = {'city': city, 'from': f'{date_from:%Y-%m-%d}', 'to': f'{date_to:%Y-%m-%d}'}
+
+    if resolution == 'auto' and points is None:
+        max_points = positive_int(request.args, 'max_points', MAX_SERIES_POINTS)
+        resolution = series_resolution(date_from, date_to, max_points)
+        if resolution is None:
+            if max_points < 3:
+                abort(400, "'max_points' must be at least 3")
+            points = max_points
+    if points is not None:
+        if points < 3:
+            abort(400, "'points' must be at least 3")
+        rows = lttb(run_query(query_temperature_series, city, date_from, date_to), points)
+        return cacheable(dict(header, resolution='lttb', columns=SERIES_COLUMNS, data=series_data(rows)))
+    if resolution != 'daily' or 'resolution' not in request.args:
+        rows = run_query(query_temperature_series, city, date_from, date_to, resolution=resolution)
+        return cacheable(dict(header, resolution=resolution, columns=SERIES_COLUMNS, data=series_data(rows)))
+
+    @stream_with_context
+    def generate():
+        # Same document as the cacheable responses, written out row by row
+        prefix = json.dumps(dict(header, resolution='daily', columns=SERIES_COLUMNS, data=[]))
+        yield prefix[:-2]
+        with current_app.extensions['db_pool'].connection() as connection:
+            for index, row in enumerate(iter_temperature_series(city, date_from, date_to, connection)):
+                yield (',' if index else '') + json.dumps(series_data([row])[0])
+        yield ']}'
+
+    return current_app.response_class(generate(), mimetype='application/json')
+
+
+def series_data(rows: list) -> list[list]:
+    return [[day.isoformat(), *temperatures] for day, *temperatures in rows]
+
+
+def positive_int(values: dict, name: str, default):
+    value = values.get(name)
+    if value is None:
+        return default
+    # isdigit() alone also accepts digits int() cannot parse, e.g. '²'
+    if not (value.isascii() and value.isdigit()) or int(value) == 0:
+        abort(400, f"'{name}' must be a positive integer")
+    return int(value)
+
+
+@api.post('/batch')
+def batch():
+    """Many lookups in one database round-trip, body: {"requests": [{"type": "temp"|"max"|"min", "city": ..., ...}]}.
+
+    "temp" lookups take a "date", "max" and "min" lookups take "from" and "to". Missing data is null.
+    """
+    body = request.get_json(silent=True)
+    items = body.get('requests') if isinstance(body, dict) else None
+    if not isinstance(items, list) or len(items) > MAX_BATCH_SIZE:
+        abort(400, f"'requests' must be a list of at most {MAX_BATCH_SIZE} lookups")
+    requests = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('type'), str) or item['type'] not in BATCH_TYPES:
+            abort(400, f"every lookup needs a 'type' out of {', '.join(BATCH_TYPES)}")
+        city = required(item, 'city')
+        if item['type'] == 'temp':
+            requests.append(TemperatureRequest('daily', city, parse_date(required(item, 'date'), 'date')))
+        else:
+            requests.append(TemperatureRequest(BATCH_TYPES[item['type']], city, *date_range(item)))
+    values = run_query(query_temperatures_batch, requests)
+    return jsonify(results=[dict(item, temperature=value) for item, value in zip(items, values)])
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import openai
+import uuid
+from quart import Quart, request, render_template, session, jsonify, Response, g
+import argparse
+from db_utils import ConnectionPool
+from query_database import TemperatureRequest
+from query_plan import build_query_plan, plan_tasks
+from chat_bot import (API_KEY, BASE_URL, plan_queries_async, answer_user_async, answer_user_stream_async, fetch_temperatures,
+                      sse_event, system_prompt, LOG_LEVELS, LOG_FORMAT, STREAM_ERROR_MESSAGE)
+from conversation import ConversationStore
+from intent_parser import IntentParser
+from response_cache import ResponseCache
+from metrics import REGISTRY, REQUEST_SECONDS, RENDER_SECONDS, ERRORS, cache_collector
+
+# Async counterpart of flask_app.py: while a request waits for the LLM the worker serves other requests.
+# Run it with `python async_app.py weather.db` or under any ASGI server, e.g.
+#   WEATHER_DB=weather.db hypercorn async_app:app
+app = Quart(__name__)
+app.config['DATABASE'] = os.getenv('WEATHER_DB')
+app.config['DB_POOL_SIZE'] = int(os.getenv('WEATHER_DB_POOL_SIZE', '8'))
+app.config['FAST_PATH'] = os.getenv('WEATHER_FAST_PATH', '1') != '0'
+app.config['RESPONSE_CACHE'] = os.getenv('WEATHER_RESPONSE_CACHE')
+app.config['TEMPLATE_RESPONSES'] = os.getenv('WEATHER_TEMPLATE_RESPONSES', '0') != '0'
+app.secret_key = os.getenv('SECRET_KEY') or os.urandom(24)
+conversations = ConversationStore(system_prompt,
+                                  max_turns=int(os.getenv('WEATHER_MAX_TURNS', '6')),
+                                  max_tokens=int(os.getenv('WEATHER_MAX_TOKENS', '3000')))
+logger = logging.getLogger(__name__)
+
+
+@app.before_serving
+async def open_resources():
+    # One client for the whole process, its HTTP connection pool keeps the connections to the LLM API alive
+    app.llm_client = openai.AsyncOpenAI(api_key=API_KEY, base_url=BASE_URL)
+    app.db_pool = ConnectionPool(app.config['DATABASE'], app.config['DB_POOL_SIZE'])
+    # SQLite calls block, so they run on threads that each borrow a pooled read-only connection
+    app.db_executor = ThreadPoolExecutor(max_workers=app.config['DB_POOL_SIZE'], thread_name_prefix='db')
+    app.intent_parser = None
+    if app.config['FAST_PATH']:
+        with app.db_pool.connection() as connection:
+            app.intent_parser = IntentParser.from_connection(connection)
+    # Reading the persisted answers and flushing them on shutdown are file I/O, kept off the event loop
+    app.response_cache = await asyncio.get_running_loop().run_in_executor(
+        app.db_executor, partial(ResponseCache, path=app.config['RESPONSE_CACHE']))
+    REGISTRY.add_collector('caches', cache_collector({
+        'response': app.response_cache.stats,
+        'intent_parser': lambda: app.intent_parser.stats() if app.intent_parser is not None else None,
+    }))
+
+
+@app.after_serving
+async def close_resources():
+    await app.llm_client.close()
+    await asyncio.get_running_loop().run_in_executor(app.db_executor, app.response_cache.close)
+    app.db_executor.shutdown()
+    app.db_pool.close()
+
+
+def _with_connection(func, *args, **kwargs):
+    with app.db_pool.connection() as connection:
+        return func(*args, connection=connection, **kwargs)
+
+
+async def run_db(func, *args, **kwargs):
+    """Run a lookup taking a `connection` argument on the DB thread pool without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(app.db_executor, partial(_with_connection, func, *args, **kwargs))
+
+
+async def fetch_plan_async(plan: list[TemperatureRequest]) -> list[str]:
+    """fetch_temperatures for every intent of a question, the plan's tasks run concurrently on the DB thread pool."""
+    tasks = plan_tasks(plan)
+    temps = [None] * len(plan)
+    results = await asyncio.gather(*(run_db(fetch_temperatures, [plan[index] for index in task]) for task in tasks))
+    for task, values in zip(tasks, results):
+        for index, value in zip(task, values):
+            temps[index] = value
+    return temps
+
+
+@app.before_request
+async def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+async def record_request(response):
+    REQUEST_SECONDS.observe(time.perf_counter() - g.start, endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+
+def current_conversation():
+    if 'conversation_id' not in session:
+        session['conversation_id'] = uuid.uuid4().hex
+    return conversations.get(session['conversation_id'])
+
+
+@app.route('/', methods=['GET', 'POST'])
+async def index():
+    if request.method == 'POST':
+        user_query = (await request.form)['user_query']
+        conversation = current_conversation()
+        daily_queries, max_time_span_param, min_time_span_param = await plan_queries_async(
+            user_query, conversation.query_messages, app.llm_client, app.intent_parser)
+        # All intents of the question are looked up in one parallel phase and answered in one LLM call
+        plan = build_query_plan(daily_queries, max_time_span_param, min_time_span_param)
+        temp = await fetch_plan_async(plan)
+        final_response = await answer_user_async(plan, temp, conversation.response_messages, user_query, app.llm_client,
+                                                 app.response_cache, app.config['TEMPLATE_RESPONSES'])
+        with RENDER_SECONDS.time(kind='page'):
+            return await render_template('index.html', user_query=user_query, assistant_response=final_response)
+
+    return await render_template('index.html')
+
+
+@app.route('/stream', methods=['POST'])
+async def stream():
+    """Same answer as index(), sent as server-sent events while the LLM generates it."""
+    user_query = (await request.form)['user_query']
+    conversation = current_conversation()
+
+    async def generate():
+        # The status line is already sent, a failure can only be reported as an event
+        try:
+            daily_queries, max_time_span_param, min_time_span_param = await plan_queries_async(
+                user_query, conversation.query_messages, app.llm_client, app.intent_parser)
+            plan = build_query_plan(daily_queries, max_time_span_param, min_time_span_param)
+            temp = await fetch_plan_async(plan)
+            async for piece in answer_user_stream_async(plan, temp, conversation.response_messages, user_query, app.llm_client,
+                                                        app.response_cache, app.config['TEMPLATE_RESPONSES']):
+                yield sse_event('token', piece)
+        except Exception:
+            logger.exception("Error while streaming the answer to %r", user_query)
+            ERRORS.inc(stage='stream')
+            yield sse_event('error', {'message': STREAM_ERROR_MESSAGE})
+            return
+        yield sse_event('done', {})
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.timeout = None
+    return response
+
+
+@app.route('/stats')
+async def stats():
+    return jsonify(intent_parser=app.intent_parser.stats() if app.intent_parser is not None else None,
+                   response_cache=app.response_cache.stats())
+
+
+@app.route('/metrics')
+async def metrics():
+    """Counters and latency histograms in the Prometheus text format."""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the weather bot asynchronously")
+    parser.add_argument("filename", help="The name of the SQLite database file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--pool-size", type=int, default=app.config['DB_POOL_SIZE'], help="Number of pooled read-only SQLite connections")
+    parser.add_argument("--no-fast-path", action="store_true", help="Always let the LLM parse the question")
+    parser.add_argument("--response-cache", metavar="PATH", default=app.config['RESPONSE_CACHE'], help="SQLite file that keeps cached answers across restarts")
+    parser.add_argument("--template-responses", action="store_true", help="Phrase standard answers locally instead of asking the LLM")
+    parser.add_argument("--log-level", default="WARNING", choices=LOG_LEVELS)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format=LOG_FORMAT)
+
+    app.config['DATABASE'] = args.filename
+    app.config['DB_POOL_SIZE'] = args.pool_size
+    app.config['FAST_PATH'] = app.config['FAST_PATH'] and not args.no_fast_path
+    app.config['RESPONSE_CACHE'] = args.response_cache
+    app.config['TEMPLATE_RESPONSES'] = app.config['TEMPLATE_RESPONSES'] or args.template_responses
+    app.run(host=args.host, port=args.port)
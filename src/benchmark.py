@@ -0,0 +1,277 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer
+from build_database import build_bulk
+from data_utils import load_data_chunks
+from generate_data import generate_csv, city_table
+from query_database import (TemperatureRequest, WeatherQueryService, query_temperature_in_city,
+                            query_max_temperature_in_time_span_per_city, query_min_temperature_in_time_span_per_city,
+                            query_temperatures_batch, query_temperature_series)
+from stub_llm_server import StubLLMHandler
+import numpy as np
+
+# Measures the ingest, query and chat paths on a generated dataset and writes the results as JSON,
+# so runs on different commits can be compared, e.g.
+#   python benchmark.py --cities 50 --output before.json
+#   python benchmark.py --cities 50 --output after.json
+
+
+def latency_stats(seconds: list[float]) -> dict:
+    milliseconds = sorted(value * 1000 for value in seconds)
+    percentiles = statistics.quantiles(milliseconds, n=100, method='inclusive')
+    return {
+        'count': len(milliseconds),
+        'mean_ms': statistics.fmean(milliseconds),
+        'p50_ms': percentiles[49],
+        'p90_ms': percentiles[89],
+        'p99_ms': percentiles[98],
+        'max_ms': milliseconds[-1],
+    }
+
+
+def timed(func, arguments: list[tuple]) -> dict:
+    timings = []
+    for args in arguments:
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return latency_stats(timings)
+
+
+def bench_ingest(csv_file: str, db_file: str, rows: int) -> dict:
+    connection = sqlite3.connect(db_file)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        build_bulk(load_data_chunks(csv_file, float_dtype='float64'), connection)
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return {'rows': rows, 'seconds': elapsed, 'rows_per_sec': rows / elapsed, 'db_bytes': os.path.getsize(db_file)}
+
+
+def bench_queries(db_file: str, cities: list[str], date_from: datetime, date_to: datetime, count: int, rng: random.Random) -> dict:
+    days = (date_to - date_from).days
+
+    def day() -> datetime:
+        return date_from + timedelta(days=rng.randrange(days + 1))
+
+    def span() -> tuple[datetime, datetime]:
+        first, last = sorted((day(), day()))
+        return first, last
+
+    points = [(rng.choice(cities), day()) for _ in range(count)]
+    spans = [(rng.choice(cities), *span()) for _ in range(count)]
+    batches = [[TemperatureRequest('daily', rng.choice(cities), day()) for _ in range(10)] for _ in range(count // 10 or 1)]
+
+    connection = sqlite3.connect(db_file, check_same_thread=False)
+    service = WeatherQueryService(connection)
+    results = {}
+    results['point'] = timed(query_temperature_in_city, [(city, date, connection) for city, date in points])
+    results['max_span'] = timed(query_max_temperature_in_time_span_per_city, [(*args, connection) for args in spans])
+    results['min_span'] = timed(query_min_temperature_in_time_span_per_city, [(*args, connection) for args in spans])
+    results['batch_of_10'] = timed(query_temperatures_batch, [(batch, connection) for batch in batches])
+    results['series_year_weekly'] = timed(query_temperature_series,
+                                          [(city, date, date + timedelta(days=365), connection, 'weekly') for city, date in points[:count // 10 or 1]])
+    results['service_point_cold'] = timed(service.temperature_in_city, points)
+    results['service_point_warm'] = timed(service.temperature_in_city, points)
+    results['service_max_span'] = timed(service.max_temperature_in_time_span, spans)
+    connection.close()
+    return results
+
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+# Imported by the entry points: the CLI's query, the chat bot, the JSON API and the analysis scripts
+STARTUP_MODULES = ['query_database', 'chat_bot', 'api', 'data_utils', 'analyze_data']
+IMPORTTIME_LINE = re.compile(r'import time:\s+\d+ \|\s+(\d+) \| (\S+)$')   # top-level imports only, nested ones are indented
+
+
+def startup_time(argv: list[str], runs: int = 3) -> dict:
+    """Wall time of `python <argv>` (best of runs) and its import time as reported by -X importtime."""
+    wall = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *argv], cwd=SRC_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wall.append(time.perf_counter() - start)
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', *argv], cwd=SRC_DIR, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True).stderr
+    imports = {}
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            imports[match.group(2)] = imports.get(match.group(2), 0) + int(match.group(1)) / 1000
+    slowest = sorted(imports.items(), key=lambda item: item[1], reverse=True)[:5]
+    return {'wall_ms': min(wall) * 1000, 'imports_ms': sum(imports.values()), 'slowest_imports_ms': dict(slowest)}
+
+
+def bench_startup(db_file: str, city: str, day: datetime) -> dict:
+    results = {'python': startup_time(['-c', 'pass']),
+               'cli_query': startup_time(['weather.py', 'query', db_file, city, f'{day:%Y-%m-%d}']),
+               'cli_help': startup_time(['weather.py', '--help'])}
+    for module in STARTUP_MODULES:
+        results[f'import_{module}'] = startup_time(['-c', f'import {module}'])
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url: str, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def load_test(send, requests: list, concurrency: int) -> dict:
+    def run(item):
+        start = time.perf_counter()
+        try:
+            send(item)
+            return time.perf_counter() - start, True
+        except Exception:
+            return time.perf_counter() - start, False
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(run, requests))
+    elapsed = time.perf_counter() - start
+    return {'requests': len(requests), 'errors': sum(not ok for _, ok in outcomes), 'concurrency': concurrency,
+            'seconds': elapsed, 'requests_per_sec': len(requests) / elapsed,
+            'latency': latency_stats([seconds for seconds, _ in outcomes])}
+
+
+def bench_flask(db_file: str, cities: list[str], date_from: datetime, date_to: datetime, count: int, concurrency: int,
+                llm_delay: float, rng: random.Random) -> dict:
+    """End-to-end requests against flask_app.py in its own process, with the stub LLM in this one."""
+    StubLLMHandler.delay = llm_delay
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), StubLLMHandler)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    port = free_port()
+    env = dict(os.environ, BASE_URL=f'http://127.0.0.1:{stub.server_address[1]}', API_KEY='stub')
+    server = subprocess.Popen([sys.executable, 'flask_app.py', db_file, '--port', str(port), '--no-debug'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    try:
+        wait_for(base + '/')
+        days = (date_to - date_from).days
+
+        def day() -> str:
+            return (date_from + timedelta(days=rng.randrange(days + 1))).strftime('%d-%m-%Y')
+
+        # Phrasings the intent parser answers locally, and ones that need the LLM to parse them
+        questions = [rng.choice([f"What was the temperature in {rng.choice(cities)} on {day()}?",
+                                 f"max temperature in {rng.choice(cities)} from {min(day(), day())} to {max(day(), day())}",
+                                 f"Tell me how it felt in {rng.choice(cities)} on {day()}, was it nice out?"])
+                     for _ in range(count)]
+        lookups = [urllib.parse.urlencode({'city': rng.choice(cities), 'date': day()}) for _ in range(count)]
+
+        def ask(question: str) -> None:
+            data = urllib.parse.urlencode({'user_query': question}).encode()
+            urllib.request.urlopen(base + '/', data=data, timeout=60).read()
+
+        def lookup(query: str) -> None:
+            try:
+                urllib.request.urlopen(f'{base}/api/temp?{query}', timeout=60).read()
+            except urllib.error.HTTPError as error:
+                if error.code != 404:
+                    raise
+
+        results = {'llm_delay': llm_delay,
+                   'chat': load_test(ask, questions, concurrency),
+                   'api_temp': load_test(lookup, lookups, concurrency)}
+        results['stats'] = json.loads(urllib.request.urlopen(base + '/stats').read())
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+        stub.shutdown()
+
+
+def environment() -> dict:
+    return {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'numpy': np.__version__}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark ingest, queries and the chat app on a generated dataset")
+    parser.add_argument("--cities", type=int, default=20, help="Cities in the generated dataset")
+    parser.add_argument("--date-from", default="01-01-2000", help="First day of the generated dataset, DD-MM-YYYY")
+    parser.add_argument("--date-to", default="31-12-2022", help="Last day of the generated dataset, DD-MM-YYYY")
+    parser.add_argument("--queries", type=int, default=1000, help="Lookups per query benchmark")
+    parser.add_argument("--requests", type=int, default=200, help="HTTP requests per app benchmark")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent HTTP clients")
+    parser.add_argument("--llm-delay", type=float, default=0.05, help="Seconds the stub LLM takes per completion")
+    parser.add_argument("--skip-app", action="store_true", help="Only benchmark ingest and queries")
+    parser.add_argument("--work-dir", help="Keep the generated CSV and database here instead of a temporary directory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    date_from = datetime.strptime(args.date_from, '%d-%m-%Y')
+    date_to = datetime.strptime(args.date_to, '%d-%m-%Y')
+    rng = random.Random(args.seed)
+    results = {'started': datetime.now().isoformat(timespec='seconds'), 'environment': environment(),
+               'dataset': {'cities': args.cities, 'date_from': args.date_from, 'date_to': args.date_to, 'seed': args.seed}}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args.work_dir or temp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        csv_file, db_file = os.path.join(work_dir, 'benchmark.csv'), os.path.join(work_dir, 'benchmark.db')
+        for path in (csv_file, db_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+        start = time.perf_counter()
+        rows = generate_csv(csv_file, args.cities, date_from, date_to, args.seed)
+        results['dataset'].update(rows=rows, csv_bytes=os.path.getsize(csv_file), generate_seconds=time.perf_counter() - start)
+        print(f"Generated {rows} rows")
+
+        results['ingest'] = bench_ingest(csv_file, db_file, rows)
+        print(f"Ingest: {results['ingest']['rows_per_sec']:,.0f} rows/sec")
+
+        cities = [city for city, _, _, _ in city_table(args.cities, np.random.default_rng(args.seed))]
+        results['queries'] = bench_queries(db_file, cities, date_from, date_to, args.queries, rng)
+        for name, stats in results['queries'].items():
+            print(f"{name:20} p50 {stats['p50_ms']:.3f}ms  p99 {stats['p99_ms']:.3f}ms")
+
+        results['startup'] = bench_startup(db_file, cities[0], date_from)
+        for name, stats in results['startup'].items():
+            print(f"{name:22} {stats['wall_ms']:.0f}ms, imports {stats['imports_ms']:.0f}ms")
+
+        if not args.skip_app:
+            results['flask_app'] = bench_flask(db_file, cities, date_from, date_to, args.requests, args.concurrency,
+                                               args.llm_delay, rng)
+            for name in ('chat', 'api_temp'):
+                stats = results['flask_app'][name]
+                print(f"flask {name:14} {stats['requests_per_sec']:.1f} req/s  p50 {stats['latency']['p50_ms']:.1f}ms  errors {stats['errors']}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+    print(f"Results written to {args.output}")
@@ -1,21 +1,22 @@
 import sqlite3
-from data_utils import load_data
+import hashlib
+import os
+import time
+from datetime import datetime
+from itertools import islice
+import pandas as pd
+from typing import Iterable, Optional
+from data_utils import load_data, load_data_chunks, CHUNK_SIZE
+from db_utils import SCHEMA_VERSION, schema_version, to_day_number
 import argparse
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Process two files - .csv and .db file")
-    parser.add_argument("csv_file", help="The name of the .csv file to process")
-    parser.add_argument("db_file", help="The name of the .db file to process")
-    args = parser.parse_args()
-    
-    df = load_data(args.csv_file)
+BATCH_SIZE = 50_000
 
-    print("database is being built")
-    connection = sqlite3.connect(args.db_file)
-    cursor = connection.cursor()
+WEATHER_COLUMNS = ['tavg', 'tmin', 'tmax', 'wdir', 'wspd', 'pres']
 
-    cursor.execute('PRAGMA foreign_keys = ON;')
 
+def create_tables(cursor: sqlite3.Cursor, set_version: bool = True) -> None:
+    """Create the current schema, set_version=False leaves user_version to a migration that sets it last."""
     # Create Cities table
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS Cities (
@@ -25,31 +26,284 @@ if __name__ == '__main__':
         lat FLOAT,
         lon FLOAT
     )""")
-    connection.commit()
 
     # Create table WeatherData
+    # WITHOUT ROWID: the rows are stored in a B-tree ordered by (city_id, date), so a point lookup
+    # or a date range of one city is a single index search and no separate index is needed
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS WeatherData (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,       -- primary key, indexed by default
-        city_id INTEGER,                            -- Foreign key to Cities table, not indexed by default
-        date DATE,
+        city_id INTEGER NOT NULL,                   -- Foreign key to Cities table
+        date INTEGER NOT NULL,                      -- day number, days since 1970-01-01 (see db_utils.to_day_number)
         temperature_avg FLOAT,
         temperature_min FLOAT,
         temperature_max FLOAT,
         wind_direction FLOAT,
         wind_speed FLOAT,
         pressure FLOAT,
+        PRIMARY KEY (city_id, date),
         FOREIGN KEY(city_id) REFERENCES Cities(id)
+    ) WITHOUT ROWID""")
+
+    # One row per ingested source file, used to skip inputs that were already loaded
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS IngestLog (
+        source TEXT PRIMARY KEY,
+        sha256 TEXT NOT NULL,
+        rows INTEGER,
+        max_date DATE,                              -- watermark: newest date seen in this source
+        ingested_at TEXT
     )""")
-    connection.commit()
 
+    # Pre-aggregated rollups per city, kept in sync by every ingest mode (see refresh_rollups)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS MonthlyStats (
+        city_id INTEGER,
+        month TEXT,                                 -- YYYY-MM
+        temperature_min FLOAT,
+        temperature_max FLOAT,
+        temperature_avg FLOAT,
+        days INTEGER,
+        PRIMARY KEY (city_id, month)
+    )""")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS YearlyStats (
+        city_id INTEGER,
+        year INTEGER,
+        temperature_min FLOAT,
+        temperature_max FLOAT,
+        temperature_avg FLOAT,
+        days INTEGER,
+        PRIMARY KEY (city_id, year)
+    )""")
+    if set_version:
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def create_indexes(cursor: sqlite3.Cursor) -> None:
     # Indexing columns for faster queries
     # Without Indexing: SQLite has to perform a full table scan for each query.
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_city_id ON WeatherData(city_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_city_name ON Cities(city);')
+    # WeatherData needs none, its (city_id, date) primary key covers every query in query_database.py
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_city_unique ON Cities(city)')
+
+
+def set_ingest_pragmas(cursor: sqlite3.Cursor) -> None:
+    """Trade durability for speed while the database is being (re)built from the CSV."""
+    cursor.execute('PRAGMA journal_mode = MEMORY;')
+    cursor.execute('PRAGMA synchronous = OFF;')
+    cursor.execute('PRAGMA cache_size = -262144;')     # negative value is in KiB, i.e. 256 MiB
+    cursor.execute('PRAGMA temp_store = MEMORY;')
+
+
+def restore_pragmas(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('PRAGMA journal_mode = DELETE;')
+    cursor.execute('PRAGMA synchronous = FULL;')
+
+
+def file_sha256(filepath: str) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def already_ingested(sha256: str, connection: sqlite3.Connection) -> bool:
+    cursor = connection.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'IngestLog'")
+    if cursor.fetchone() is None:
+        return False
+    cursor.execute('SELECT 1 FROM IngestLog WHERE sha256 = ?', (sha256,))
+    return cursor.fetchone() is not None
+
+
+def has_weather_data(connection: sqlite3.Connection) -> bool:
+    if not connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'WeatherData'").fetchone():
+        return False
+    return connection.execute('SELECT 1 FROM WeatherData LIMIT 1').fetchone() is not None
+
+
+def record_ingest(source: str, sha256: str, rows: int, max_date: Optional[str], cursor: sqlite3.Cursor) -> None:
+    cursor.execute("""
+        INSERT INTO IngestLog (source, sha256, rows, max_date, ingested_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(source) DO UPDATE SET
+            sha256 = excluded.sha256, rows = excluded.rows,
+            max_date = excluded.max_date, ingested_at = excluded.ingested_at""",
+        (source, sha256, rows, max_date, datetime.now().isoformat(timespec='seconds')))
+
+
+def refresh_rollups(cursor: sqlite3.Cursor, touched_months: Optional[set[tuple[int, str]]] = None) -> None:
+    """Recompute MonthlyStats/YearlyStats, for all data or only for the (city_id, YYYY-MM) pairs given."""
+    cursor.execute('DROP TABLE IF EXISTS temp.TouchedMonths')
+    cursor.execute('CREATE TEMP TABLE TouchedMonths (city_id INTEGER, month TEXT, PRIMARY KEY (city_id, month))')
+    if touched_months is None:
+        cursor.execute("INSERT INTO TouchedMonths SELECT DISTINCT city_id, strftime('%Y-%m', date * 86400, 'unixepoch') FROM WeatherData")
+    else:
+        cursor.executemany('INSERT OR IGNORE INTO TouchedMonths VALUES (?, ?)', touched_months)
+
+    cursor.execute('DELETE FROM MonthlyStats WHERE (city_id, month) IN (SELECT city_id, month FROM TouchedMonths)')
+    cursor.execute("""
+        INSERT INTO MonthlyStats (city_id, month, temperature_min, temperature_max, temperature_avg, days)
+        SELECT t.city_id, t.month, MIN(w.temperature_min), MAX(w.temperature_max), AVG(w.temperature_avg), COUNT(*)
+        FROM TouchedMonths t
+        JOIN WeatherData w ON w.city_id = t.city_id
+            AND w.date BETWEEN CAST(julianday(t.month || '-01') - 2440587.5 AS INTEGER)
+                           AND CAST(julianday(t.month || '-01', '+1 month', '-1 day') - 2440587.5 AS INTEGER)
+        GROUP BY t.city_id, t.month""")
+
+    # Years are rolled up from the months, weighting the averages by the number of days
+    cursor.execute("""
+        DELETE FROM YearlyStats
+        WHERE (city_id, year) IN (SELECT DISTINCT city_id, CAST(substr(month, 1, 4) AS INTEGER) FROM TouchedMonths)""")
+    cursor.execute("""
+        INSERT INTO YearlyStats (city_id, year, temperature_min, temperature_max, temperature_avg, days)
+        SELECT m.city_id, t.year, MIN(m.temperature_min), MAX(m.temperature_max),
+               SUM(m.temperature_avg * m.days) / SUM(m.days), SUM(m.days)
+        FROM (SELECT DISTINCT city_id, CAST(substr(month, 1, 4) AS INTEGER) AS year FROM TouchedMonths) t
+        JOIN MonthlyStats m ON m.city_id = t.city_id AND m.month BETWEEN t.year || '-01' AND t.year || '-12'
+        GROUP BY m.city_id, t.year""")
+    cursor.execute('DROP TABLE temp.TouchedMonths')
+
+
+def touched_months(df: pd.DataFrame, city_ids: dict[str, int]) -> set[tuple[int, str]]:
+    months = pd.DataFrame({'city_id': df['city'].map(city_ids).astype('int64'),
+                           'month': df['date'].dt.strftime('%Y-%m')}).drop_duplicates()
+    return set(zip(months['city_id'].tolist(), months['month'].tolist()))
+
+
+def insert_cities(df: pd.DataFrame, cursor: sqlite3.Cursor) -> None:
+    cities = df[['city', 'country', 'Latitude', 'Longitude']].drop_duplicates(subset='city')
+    cursor.executemany("""
+        INSERT OR IGNORE INTO Cities (city, country, lat, lon)
+        VALUES (?, ?, ?, ?)""",
+        zip(cities['city'].tolist(), cities['country'].tolist(),
+            cities['Latitude'].tolist(), cities['Longitude'].tolist()))
+
+
+def load_city_ids(cursor: sqlite3.Cursor) -> dict[str, int]:
+    """Resolve every city name to its id once, instead of a SELECT per weather row."""
+    cursor.execute('SELECT city, id FROM Cities')
+    return dict(cursor.fetchall())
+
+
+def resolve_city_ids(df: pd.DataFrame, city_ids: dict[str, int], cursor: sqlite3.Cursor) -> dict[str, int]:
+    """Insert the cities of this chunk that are not known yet and return the updated mapping."""
+    new_cities = df[~df['city'].isin(list(city_ids))]
+    if new_cities.empty:
+        return city_ids
+    insert_cities(new_cities, cursor)
+    return load_city_ids(cursor)
+
+
+def weather_rows(df: pd.DataFrame, city_ids: dict[str, int]) -> zip:
+    """Turn the DataFrame into column arrays zipped into WeatherData parameter tuples."""
+    city_id = df['city'].map(city_ids).tolist()
+    # datetime64[D] counts days since 1970-01-01, exactly the stored day number
+    date = df['date'].to_numpy().astype('datetime64[D]').astype('int64').tolist()
+    columns = [df[column].tolist() for column in WEATHER_COLUMNS]
+    return zip(city_id, date, *columns)
+
+
+def bulk_insert_weather(rows, cursor: sqlite3.Cursor, batch_size: int = BATCH_SIZE) -> int:
+    rows = iter(rows)
+    inserted = 0
+    while batch := list(islice(rows, batch_size)):
+        cursor.executemany("""
+        INSERT INTO WeatherData (city_id, date, temperature_avg, temperature_min, temperature_max, wind_direction, wind_speed, pressure)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        batch)
+        inserted += len(batch)
+    return inserted
+
+
+def build_bulk(chunks: Iterable[pd.DataFrame], connection: sqlite3.Connection) -> None:
+    """Load all chunks in one transaction and index the table afterwards."""
+    cursor = connection.cursor()
+    set_ingest_pragmas(cursor)
+    cursor.execute('PRAGMA foreign_keys = ON;')
+    create_tables(cursor)
+
+    start = time.perf_counter()
+    inserted = 0
+    with connection:
+        city_ids = load_city_ids(cursor)
+        for df in chunks:
+            city_ids = resolve_city_ids(df, city_ids, cursor)
+            inserted += bulk_insert_weather(weather_rows(df, city_ids), cursor)
+    elapsed = time.perf_counter() - start
+    print(f"WeatherData table is filled: {inserted} rows in {elapsed:.2f}s ({inserted / max(elapsed, 1e-9):,.0f} rows/sec)")
+
+    # Building the indexes once over the loaded table is cheaper than updating them on every insert
+    start = time.perf_counter()
+    with connection:
+        create_indexes(cursor)
+    print(f"Indexes built in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    with connection:
+        refresh_rollups(cursor)
+    print(f"Monthly and yearly rollups built in {time.perf_counter() - start:.2f}s")
+    restore_pragmas(cursor)
+
+
+def upsert_weather(rows, cursor: sqlite3.Cursor, batch_size: int = BATCH_SIZE) -> int:
+    rows = iter(rows)
+    upserted = 0
+    while batch := list(islice(rows, batch_size)):
+        cursor.executemany("""
+        INSERT INTO WeatherData (city_id, date, temperature_avg, temperature_min, temperature_max, wind_direction, wind_speed, pressure)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(city_id, date) DO UPDATE SET
+            temperature_avg = excluded.temperature_avg,
+            temperature_min = excluded.temperature_min,
+            temperature_max = excluded.temperature_max,
+            wind_direction = excluded.wind_direction,
+            wind_speed = excluded.wind_speed,
+            pressure = excluded.pressure""",
+        batch)
+        upserted += len(batch)
+    return upserted
+
+
+def build_incremental(chunks: Iterable[pd.DataFrame], source: str, sha256: str, connection: sqlite3.Connection) -> None:
+    """Upsert a CSV slice into an existing database; rerunning the same slice changes nothing."""
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA foreign_keys = ON;')
+    with connection:
+        create_tables(cursor)
+        create_indexes(cursor)
+
+    start = time.perf_counter()
+    upserted = 0
+    max_date = None
+    months = set()
+    with connection:
+        city_ids = load_city_ids(cursor)
+        for df in chunks:
+            city_ids = resolve_city_ids(df, city_ids, cursor)
+            upserted += upsert_weather(weather_rows(df, city_ids), cursor)
+            months |= touched_months(df, city_ids)
+            if len(df):
+                chunk_max_date = df['date'].max().strftime('%Y-%m-%d')
+                max_date = max(max_date or chunk_max_date, chunk_max_date)
+        # Only the months that received rows are re-aggregated
+        refresh_rollups(cursor, months)
+        record_ingest(source, sha256, upserted, max_date, cursor)
+    elapsed = time.perf_counter() - start
+    print(f"WeatherData upserted: {upserted} rows in {elapsed:.2f}s ({upserted / max(elapsed, 1e-9):,.0f} rows/sec)")
+
+
+def build_row_by_row(df: pd.DataFrame, connection: sqlite3.Connection) -> None:
+    cursor = connection.cursor()
+
+    cursor.execute('PRAGMA foreign_keys = ON;')
+    create_tables(cursor)
     connection.commit()
 
-    # Insert data to Cities 
+    create_indexes(cursor)
+    connection.commit()
+
+    # Insert data to Cities
     for index, row in df[['city', 'country', 'Latitude', 'Longitude']].drop_duplicates().iterrows():
         cursor.execute("""
         INSERT OR IGNORE INTO Cities (city, country, lat, lon)
@@ -58,6 +312,7 @@ if __name__ == '__main__':
     connection.commit()
     print("Cities table is filled")
 
+    start = time.perf_counter()
     # Insert data to WeatherData. Whenever you need to pass a single parameter to SQL query make it a TUPLE.
     for index, row in df.iterrows():
         cursor.execute('SELECT id FROM Cities WHERE city = ?', (row['city'],))
@@ -66,9 +321,56 @@ if __name__ == '__main__':
         cursor.execute("""
         INSERT INTO WeatherData (city_id, date, temperature_avg, temperature_min, temperature_max, wind_direction, wind_speed, pressure)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-        (city_id, row['date'].strftime('%Y-%m-%d'), row['tavg'], row['tmin'], row['tmax'], row['wdir'], row['wspd'], row['pres']))
+        (city_id, to_day_number(row['date']), row['tavg'], row['tmin'], row['tmax'], row['wdir'], row['wspd'], row['pres']))
+    connection.commit()
+    elapsed = time.perf_counter() - start
+    print(f"WeatherData table is filled: {len(df)} rows in {elapsed:.2f}s ({len(df) / max(elapsed, 1e-9):,.0f} rows/sec)")
+
+    refresh_rollups(cursor)
     connection.commit()
-    print("WeatherData table is filled")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Process two files - .csv and .db file")
+    parser.add_argument("csv_file", help="The name of the .csv file to process")
+    parser.add_argument("db_file", help="The name of the .db file to process")
+    parser.add_argument("--mode", choices=["bulk", "incremental", "row"], default="bulk",
+                        help="bulk: full build into an empty database, batched executemany in one transaction, indexes built after the load; "
+                             "incremental: upsert a (daily) CSV slice into an existing database, unchanged files are skipped; "
+                             "row: insert one row at a time")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="Number of CSV rows parsed at a time in bulk and incremental mode")
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(args.db_file)
+
+    version = schema_version(connection)
+    if version not in (0, SCHEMA_VERSION):
+        connection.close()
+        raise SystemExit(f"{args.db_file} has schema version {version}, upgrade it first: python migrate_database.py {args.db_file}")
+
+    # bulk and row mode insert every row and would hit the (city_id, date) primary key of existing data
+    if args.mode != "incremental" and has_weather_data(connection):
+        connection.close()
+        raise SystemExit(f"{args.db_file} already contains weather data, add to it with --mode incremental or build into a new file")
+
+    if args.mode == "incremental":
+        sha256 = file_sha256(args.csv_file)
+        if already_ingested(sha256, connection):
+            print(f"{args.csv_file} was already ingested, skipping")
+            connection.close()
+            raise SystemExit(0)
+
+    print("database is being built")
+
+    # float64 so the stored values match the CSV exactly
+    if args.mode == "bulk":
+        build_bulk(load_data_chunks(args.csv_file, args.chunk_size, float_dtype='float64'), connection)
+    elif args.mode == "incremental":
+        build_incremental(load_data_chunks(args.csv_file, args.chunk_size, float_dtype='float64'),
+                          os.path.abspath(args.csv_file), sha256, connection)
+    else:
+        build_row_by_row(load_data(args.csv_file), connection)
 
     connection.close()
-    print("Database connection closed")
\ No newline at end of file
+    print("Database connection closed")
@@ -1,19 +1,33 @@
-import openai
-from query_database import query_temperature_in_city, query_max_temperature_in_time_span_per_city, query_min_temperature_in_time_span_per_city
+from query_database import query_temperature_in_city, query_max_temperature_in_time_span_per_city, query_min_temperature_in_time_span_per_city, WeatherQueryService, TemperatureRequest, query_temperatures_batch
 import argparse
-from db_utils import create_connection
+from db_utils import create_connection, ConnectionPool
+from intent_parser import IntentParser
+from response_cache import ResponseCache, is_cacheable, render_response
+from query_plan import QueryPlanExecutor, build_query_plan
+from metrics import LLM_SECONDS, LLM_FIRST_TOKEN_SECONDS, EXTRACT_SECONDS, DB_SECONDS, RENDER_SECONDS, ERRORS, record_usage
 import sqlite3
 from datetime import datetime
+import json
+import logging
 import os
 import re
-from typing import Tuple, Optional, List
+import time
+from functools import lru_cache
+from typing import Tuple, Optional, List, Union, Iterator, AsyncIterator, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import openai
 
 
 API_KEY = os.getenv("API_KEY")  # Retrieve the API key
 URL = "https://openrouter.ai/api/v1/chat/completions"
-BASE_URL = "https://openrouter.ai/api/v1"
+BASE_URL = os.getenv("BASE_URL", "https://openrouter.ai/api/v1")  # point at stub_llm_server.py for local testing
 MODEL = "mistralai/mistral-7b-instruct:free"
 
+logger = logging.getLogger(__name__)
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
 
 system_prompt = """
     You are a helpful weather bot. I am leveraging you to read data from the database and talk to the actual user.
@@ -79,8 +93,11 @@ system_prompt = """
 
 
 
-# pravi se stalno, me treba da bude globalna. neka ide u Flask
-client = openai.OpenAI(api_key=API_KEY, base_url=BASE_URL)
+@lru_cache(maxsize=None)
+def get_client() -> 'openai.OpenAI':
+    """The process-wide client, built on first use: importing openai takes longer than the rest of this module."""
+    import openai
+    return openai.OpenAI(api_key=API_KEY, base_url=BASE_URL)
 
 query_messages = [{"role": "system", "content": system_prompt}]
 response_messages = [{"role": "system", "content": system_prompt}]
@@ -88,20 +105,34 @@ response_messages = [{"role": "system", "content": system_prompt}]
 def get_assistant_query(user_query: str, query_messages: list[dict]) -> str:
     """Ask the AI to format a database query and return it."""
     query_messages.append({'role': 'user', 'content': f'---USER--- {user_query}'})
-    print('user_query added to messages\n')
-    assistant_query = client.chat.completions.create(
-            model=MODEL,
-            messages=query_messages,
-            temperature=0.1).choices[0].message.content
-    print('assistant query added to messages\n')
+    with LLM_SECONDS.time(call='parse'):
+        response = get_client().chat.completions.create(
+                model=MODEL,
+                messages=query_messages,
+                temperature=0.1)
+    record_usage(response.usage)
+    assistant_query = response.choices[0].message.content
+    logger.debug('assistant query: %s', assistant_query)
     return assistant_query
 
 
+async def get_assistant_query_async(user_query: str, query_messages: list[dict], async_client: 'openai.AsyncOpenAI') -> str:
+    """Same as get_assistant_query, without blocking the event loop while the LLM answers."""
+    query_messages.append({'role': 'user', 'content': f'---USER--- {user_query}'})
+    with LLM_SECONDS.time(call='parse'):
+        response = await async_client.chat.completions.create(
+                model=MODEL,
+                messages=query_messages,
+                temperature=0.1)
+    record_usage(response.usage)
+    return response.choices[0].message.content
+
+
 def extract_city_date(assistant_response: str) -> Tuple[List[Tuple[str, datetime]], List[Tuple[str, datetime, datetime]], List[Tuple[str, datetime, datetime]]]:
     """Extract city and date from AI-generated query."""
     single_day_matches = re.findall(r"(?<!<\w)_?<TEMP><([\w\s]+)><(\d{2}-\d{2}-\d{4})>", assistant_response)
     daily_queries = [(city, datetime.strptime(date_str, '%d-%m-%Y')) for city, date_str in single_day_matches]
-    print(daily_queries)
+    logger.debug('daily queries: %s', daily_queries)
 
     max_time_span = re.search(r"(?<!<\w)_?<MAX_TEMP><([\w\s]+)><(\d{2}-\d{2}-\d{4})><(\d{2}-\d{2}-\d{4})>", assistant_response)
     max_time_span_param = None
@@ -122,15 +153,60 @@ def extract_city_date(assistant_response: str) -> Tuple[List[Tuple[str, datetime
     return daily_queries, max_time_span_param, min_time_span_param
 
 
-def fetch_temperature(city: str, date: datetime, query_type: str, connection: sqlite3.Connection, date_to: Optional[datetime] = None) -> str:  
+def parse_locally(user_query: str, intent_parser: Optional[IntentParser]):
+    if intent_parser is None:
+        return None
+    with EXTRACT_SECONDS.time(method='intent_parser'):
+        return intent_parser.parse(user_query)
+
+
+def plan_queries(user_query: str, query_messages: list[dict], intent_parser: Optional[IntentParser] = None):
+    """Turn the user's question into database queries, without the LLM when the intent parser is confident."""
+    parsed = parse_locally(user_query, intent_parser)
+    if parsed is not None:
+        # Keep the question in the history so follow-ups that do reach the LLM have the context
+        query_messages.append({'role': 'user', 'content': f'---USER--- {user_query}'})
+        return parsed
+    start = time.perf_counter()
+    assistant_query = get_assistant_query(user_query, query_messages)
+    if intent_parser is not None:
+        intent_parser.record_fallback(time.perf_counter() - start)
+    with EXTRACT_SECONDS.time(method='regex'):
+        return extract_city_date(assistant_query)
+
+
+async def plan_queries_async(user_query: str, query_messages: list[dict], async_client: 'openai.AsyncOpenAI', intent_parser: Optional[IntentParser] = None):
+    """Same as plan_queries, without blocking the event loop while the LLM answers."""
+    parsed = parse_locally(user_query, intent_parser)
+    if parsed is not None:
+        query_messages.append({'role': 'user', 'content': f'---USER--- {user_query}'})
+        return parsed
+    start = time.perf_counter()
+    assistant_query = await get_assistant_query_async(user_query, query_messages, async_client)
+    if intent_parser is not None:
+        intent_parser.record_fallback(time.perf_counter() - start)
+    with EXTRACT_SECONDS.time(method='regex'):
+        return extract_city_date(assistant_query)
+
+
+def fetch_temperature(city: str, date: datetime, query_type: str, connection: Union[sqlite3.Connection, WeatherQueryService], date_to: Optional[datetime] = None) -> str:  
     temp = None
     try:
-        if query_type == 'daily':  
-            temp = query_temperature_in_city(city, date, connection)
-        elif query_type == 'max_span':
-            temp = query_max_temperature_in_time_span_per_city(city, date, date_to, connection) 
-        elif query_type == 'min_span':
-            temp = query_min_temperature_in_time_span_per_city(city, date, date_to, connection)
+        with DB_SECONDS.time(query=query_type):
+            if isinstance(connection, WeatherQueryService):
+                # Cached path, repeated questions are answered without touching the database
+                if query_type == 'daily':
+                    temp = connection.temperature_in_city(city, date)
+                elif query_type == 'max_span':
+                    temp = connection.max_temperature_in_time_span(city, date, date_to)
+                elif query_type == 'min_span':
+                    temp = connection.min_temperature_in_time_span(city, date, date_to)
+            elif query_type == 'daily':  
+                temp = query_temperature_in_city(city, date, connection)
+            elif query_type == 'max_span':
+                temp = query_max_temperature_in_time_span_per_city(city, date, date_to, connection) 
+            elif query_type == 'min_span':
+                temp = query_min_temperature_in_time_span_per_city(city, date, date_to, connection)
         
         if temp is None:
             return f"No data available for {city} on {date.strftime('%d-%m-%Y')}"
@@ -138,63 +214,227 @@ def fetch_temperature(city: str, date: datetime, query_type: str, connection: sq
         return str(temp)
     
     except Exception as e:
-        print(f"Error while fetching temperature: {e}")
+        logger.warning("Error while fetching temperature: %s", e)
+        ERRORS.inc(stage='fetch')
         return f"No data available for {city} on {date.strftime('%d-%m-%Y')}"
     
 
-def respond_to_user(db_responses: list[str], response_messages: list[dict], user_query: str) -> str:
-    """Generate a user response based on multiple temperature data responses."""
+def fetch_temperatures(requests: list[TemperatureRequest], connection: Union[sqlite3.Connection, WeatherQueryService]) -> list[str]:
+    """Batch version of fetch_temperature, all lookups are resolved in one database round-trip."""
+    try:
+        with DB_SECONDS.time(query='batch'):
+            if isinstance(connection, WeatherQueryService):
+                temps = connection.query_batch(requests)
+            else:
+                temps = query_temperatures_batch(requests, connection)
+    except Exception as e:
+        logger.warning("Error while fetching temperatures: %s", e)
+        ERRORS.inc(stage='fetch')
+        temps = [None] * len(requests)
+    return format_temperatures(requests, temps)
+
+
+def fetch_plan(plan: list[TemperatureRequest], executor: QueryPlanExecutor, service: Optional[WeatherQueryService] = None) -> list[str]:
+    """fetch_temperatures for every intent of a question at once, the lookups run in parallel over the executor's pool."""
+    try:
+        with DB_SECONDS.time(query='plan'):
+            temps = executor.run(plan, service)
+    except Exception as e:
+        logger.warning("Error while fetching temperatures: %s", e)
+        ERRORS.inc(stage='fetch')
+        temps = [None] * len(plan)
+    return format_temperatures(plan, temps)
+
+
+def format_temperatures(requests: list[TemperatureRequest], temps: list[Optional[float]]) -> list[str]:
+    return [str(temp) if temp is not None else f"No data available for {request.city} on {request.date.strftime('%d-%m-%Y')}"
+            for request, temp in zip(requests, temps)]
+
+
+def add_values(db_responses: list[str], response_messages: list[dict], user_query: str) -> None:
     response_messages.append({'role': 'user', 'content': f'---USER--- {user_query}'})
     for db_response in db_responses:
         response_messages.append({'role': 'system', 'content': f'<VALUE>{db_response}'})
-    final_response = client.chat.completions.create(
-        model=MODEL,
-        messages=response_messages,
-        temperature=0.1
-    ).choices[0].message.content
-    return final_response
 
 
+def respond_to_user(db_responses: list[str], response_messages: list[dict], user_query: str) -> str:
+    """Generate a user response based on multiple temperature data responses."""
+    add_values(db_responses, response_messages, user_query)
+    with LLM_SECONDS.time(call='respond'):
+        response = get_client().chat.completions.create(
+            model=MODEL,
+            messages=response_messages,
+            temperature=0.1)
+    record_usage(response.usage)
+    return response.choices[0].message.content
+
+
+async def respond_to_user_async(db_responses: list[str], response_messages: list[dict], user_query: str, async_client: 'openai.AsyncOpenAI') -> str:
+    """Same as respond_to_user, without blocking the event loop while the LLM answers."""
+    add_values(db_responses, response_messages, user_query)
+    with LLM_SECONDS.time(call='respond'):
+        response = await async_client.chat.completions.create(
+            model=MODEL,
+            messages=response_messages,
+            temperature=0.1)
+    record_usage(response.usage)
+    return response.choices[0].message.content
+
+
+def respond_to_user_stream(db_responses: list[str], response_messages: list[dict], user_query: str) -> Iterator[str]:
+    """Same as respond_to_user, yielding the response piece by piece as the LLM generates it."""
+    add_values(db_responses, response_messages, user_query)
+    with LLM_SECONDS.time(call='respond_stream'):
+        start = time.perf_counter()
+        stream = get_client().chat.completions.create(
+            model=MODEL,
+            messages=response_messages,
+            temperature=0.1,
+            stream=True,
+            stream_options={'include_usage': True})
+        first = True
+        for chunk in stream:
+            record_usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first:
+                    LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start)
+                    first = False
+                yield chunk.choices[0].delta.content
+
+
+async def respond_to_user_stream_async(db_responses: list[str], response_messages: list[dict], user_query: str, async_client: 'openai.AsyncOpenAI') -> AsyncIterator[str]:
+    """Same as respond_to_user_stream, without blocking the event loop while the LLM answers."""
+    add_values(db_responses, response_messages, user_query)
+    with LLM_SECONDS.time(call='respond_stream'):
+        start = time.perf_counter()
+        stream = await async_client.chat.completions.create(
+            model=MODEL,
+            messages=response_messages,
+            temperature=0.1,
+            stream=True,
+            stream_options={'include_usage': True})
+        first = True
+        async for chunk in stream:
+            record_usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first:
+                    LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start)
+                    first = False
+                yield chunk.choices[0].delta.content
+
+
+def cached_response(requests: list[TemperatureRequest], db_responses: list[str], response_messages: list[dict], user_query: str,
+                    response_cache: Optional[ResponseCache] = None, use_templates: bool = False) -> Tuple[Optional[str], Optional[str]]:
+    """Answer from the template renderer or the response cache, returns (response, cache key to store the LLM's answer under)."""
+    response = None
+    if not is_cacheable(requests):
+        return None, None
+    if use_templates:
+        with RENDER_SECONDS.time(kind='answer_template'):
+            response = render_response(requests, db_responses)
+    key = ResponseCache.key(requests, db_responses) if response_cache is not None and response is None else None
+    if key is not None:
+        response = response_cache.get(key)
+    if response is not None:
+        # The history still records the question and values, as if the LLM had been asked
+        add_values(db_responses, response_messages, user_query)
+    return response, key
+
+
+def answer_user(requests: list[TemperatureRequest], db_responses: list[str], response_messages: list[dict], user_query: str,
+                response_cache: Optional[ResponseCache] = None, use_templates: bool = False) -> str:
+    """respond_to_user, skipped when the same queries with the same values were answered before."""
+    response, key = cached_response(requests, db_responses, response_messages, user_query, response_cache, use_templates)
+    if response is None:
+        response = respond_to_user(db_responses, response_messages, user_query)
+        if key is not None:
+            response_cache.put(key, response)
+    return response
+
+
+async def answer_user_async(requests: list[TemperatureRequest], db_responses: list[str], response_messages: list[dict], user_query: str,
+                            async_client: 'openai.AsyncOpenAI', response_cache: Optional[ResponseCache] = None, use_templates: bool = False) -> str:
+    """Same as answer_user, without blocking the event loop while the LLM answers."""
+    response, key = cached_response(requests, db_responses, response_messages, user_query, response_cache, use_templates)
+    if response is None:
+        response = await respond_to_user_async(db_responses, response_messages, user_query, async_client)
+        if key is not None:
+            response_cache.put(key, response)
+    return response
+
+
+def answer_user_stream(requests: list[TemperatureRequest], db_responses: list[str], response_messages: list[dict], user_query: str,
+                       response_cache: Optional[ResponseCache] = None, use_templates: bool = False) -> Iterator[str]:
+    """Streaming answer_user, a cached or templated answer arrives as a single piece."""
+    response, key = cached_response(requests, db_responses, response_messages, user_query, response_cache, use_templates)
+    if response is not None:
+        yield response
+        return
+    pieces = []
+    for piece in respond_to_user_stream(db_responses, response_messages, user_query):
+        pieces.append(piece)
+        yield piece
+    if key is not None:
+        response_cache.put(key, ''.join(pieces))
+
+
+async def answer_user_stream_async(requests: list[TemperatureRequest], db_responses: list[str], response_messages: list[dict], user_query: str,
+                                   async_client: 'openai.AsyncOpenAI', response_cache: Optional[ResponseCache] = None,
+                                   use_templates: bool = False) -> AsyncIterator[str]:
+    """Same as answer_user_stream, without blocking the event loop while the LLM answers."""
+    response, key = cached_response(requests, db_responses, response_messages, user_query, response_cache, use_templates)
+    if response is not None:
+        yield response
+        return
+    pieces = []
+    async for piece in respond_to_user_stream_async(db_responses, response_messages, user_query, async_client):
+        pieces.append(piece)
+        yield piece
+    if key is not None:
+        response_cache.put(key, ''.join(pieces))
+
+
+# Sent as an "error" event when answering a streamed question fails, the details are only logged
+STREAM_ERROR_MESSAGE = "Sorry, something went wrong while answering your question. Please try again."
+
+
+def sse_event(event: str, data) -> str:
+    """One server-sent event, data is JSON encoded so newlines in tokens survive the framing."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Query SQLite database")
     parser.add_argument("filename", help="The name of the SQLite database file")
+    parser.add_argument("--no-fast-path", action="store_true", help="Always let the LLM parse the question")
+    parser.add_argument("--response-cache", metavar="PATH", help="SQLite file that keeps cached answers across runs")
+    parser.add_argument("--template-responses", action="store_true", help="Phrase standard answers locally instead of asking the LLM")
+    parser.add_argument("--log-level", default="INFO", choices=LOG_LEVELS, help="DEBUG also logs the LLM's queries")
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format=LOG_FORMAT)
 
     connection = create_connection(args.filename)
+    intent_parser = None if args.no_fast_path else IntentParser.from_connection(connection)
+    response_cache = ResponseCache(path=args.response_cache) if args.response_cache else None
+    # A question mixes at most daily lookups, a max span and a min span: three parallel tasks
+    plan_executor = QueryPlanExecutor(ConnectionPool(args.filename, size=3))
     user_query = input("Enter your weather query: ")
 
-    assistant_query = get_assistant_query(user_query, query_messages)
-    print("Assistant Query:", assistant_query)
+    daily_queries, max_time_span_param, min_time_span_param = plan_queries(user_query, query_messages, intent_parser)
+    if intent_parser is not None and intent_parser.hits:
+        logger.info("Query parsed locally, skipped the LLM")
 
-    daily_queries, max_time_span_param, min_time_span_param = extract_city_date(assistant_query)
-    
     # Daily Queries: [('Belgrade', datetime.datetime(2020, 10, 1, 0, 0)), ('Zagreb', datetime.datetime(2020, 10, 1, 0, 0))]
-    if daily_queries is not None:
-        cities_daily = [city for city, _ in daily_queries]
-        date_objects_daily = [date for _, date in daily_queries]
-        print(f'cities daily: {cities_daily}, datetime objects daily: {date_objects_daily}\n')
-        query_type = 'daily'
-        temp = []
-        for city, date_object in zip(cities_daily, date_objects_daily):
-            temp.append(fetch_temperature(city, date_object, query_type, connection))
-            print(f'db_response: {temp}')
-        final_response = respond_to_user(temp, response_messages, user_query)
-        print(final_response)
-    if max_time_span_param is not None:
-        city_max, date_from_object_max, date_to_object_max = max_time_span_param
-        print(f'city in max time span: {city_max}, date_from: {date_from_object_max}, date_to: {date_to_object_max}\n')
-        query_type = 'max_span'
-        temp = fetch_temperature(city_max, date_from_object_max, query_type, connection, date_to_object_max)
-        print(f'db_response: {temp}')
-        final_response = respond_to_user(temp, response_messages, user_query)
-        print(final_response)
-    if min_time_span_param is not None:
-        city_min, date_from_object_min, date_to_object_min = min_time_span_param
-        query_type = 'min_span'
-        temp = fetch_temperature(city_min, date_from_object_min, query_type, connection, date_to_object_min)
-        print(f'db_response: {temp}')
-        final_response = respond_to_user(temp, response_messages, user_query)
-        print(final_response)
+    plan = build_query_plan(daily_queries, max_time_span_param, min_time_span_param)
+    logger.info('query plan: %s', plan)
+    temp = fetch_plan(plan, plan_executor)
+    logger.info('db_response: %s', temp)
+    # One answer for all intents of the question
+    final_response = answer_user(plan, temp, response_messages, user_query, response_cache, args.template_responses)
+    print(final_response)
 
+    plan_executor.close()
+    plan_executor.pool.close()
     connection.close()
+    if response_cache is not None:
+        response_cache.close()
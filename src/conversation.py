@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+
+def estimate_tokens(message: dict) -> int:
+    # Roughly 4 characters per token for English text, close enough for budgeting
+    return len(message['content']) // 4 + 4
+
+
+class Conversation:
+    """Message history of one user, in the shape get_assistant_query/respond_to_user expect."""
+
+    def __init__(self, system_prompt: str):
+        self.query_messages = [{"role": "system", "content": system_prompt}]
+        self.response_messages = [{"role": "system", "content": system_prompt}]
+
+    def trim(self, max_turns: int, max_tokens: int) -> None:
+        """Drop the oldest turns so a new turn fits into max_turns turns and max_tokens tokens."""
+        for messages in (self.query_messages, self.response_messages):
+            system, history = messages[0], messages[1:]
+            # A turn starts with the user's message, followed by the <VALUE> messages of the database
+            turns = []
+            for message in history:
+                if message['role'] == 'user' or not turns:
+                    turns.append([])
+                turns[-1].append(message)
+
+            budget = max_tokens - estimate_tokens(system)
+            kept = []
+            for turn in reversed(turns[-(max_turns - 1):] if max_turns > 1 else []):
+                budget -= sum(estimate_tokens(message) for message in turn)
+                if budget < 0:
+                    break
+                kept.insert(0, turn)
+            messages[:] = [system] + [message for turn in kept for message in turn]
+
+
+class ConversationStore:
+    """Per-session conversations held in memory, the least recently used sessions are evicted.
+
+    Every session's prompt is capped at max_turns turns and max_tokens tokens, so the
+    prompt sent per request stays bounded no matter how long a session runs.
+    """
+
+    def __init__(self, system_prompt: str, max_sessions: int = 10_000, max_turns: int = 6, max_tokens: int = 3000):
+        self.system_prompt = system_prompt
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Conversation:
+        """Return the session's conversation, trimmed to leave room for the next turn."""
+        with self._lock:
+            conversation = self._sessions.get(session_id)
+            if conversation is None:
+                conversation = self._sessions[session_id] = Conversation(self.system_prompt)
+                if len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+        conversation.trim(self.max_turns, self.max_tokens)
+        return conversation
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -1,12 +1,190 @@
+import json
+import os
+import shutil
+import tempfile
+import uuid
 import pandas as pd
+from datetime import datetime
+from typing import Iterator, Optional
 
-def load_data(filepath: str) -> pd.DataFrame:
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+except ImportError:     # the cache is an optimization, plain CSV parsing still works without pyarrow
+    pa = None
+
+CHUNK_SIZE = 500_000
+
+MEASUREMENT_COLUMNS = ['tavg', 'tmin', 'tmax', 'wdir', 'wspd', 'pres']
+
+CSV_COLUMNS = ['city', 'country', 'Latitude', 'Longitude', 'date', *MEASUREMENT_COLUMNS]
+
+CACHE_SUFFIX = '.arrow'
+CACHE_SOURCE_FILE = '_source.json'
+
+
+def load_data(
+        filepath: str,
+        columns: Optional[list[str]] = None,
+        cities: Optional[list[str]] = None,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+        use_cache: bool = True) -> pd.DataFrame:
+    """Load the dataset, optionally only some columns and some cities/dates.
+
+    The first call writes a columnar Arrow cache next to the CSV, partitioned by city.
+    Later calls memory-map it and read only the requested columns and partitions.
+    """
     assert filepath.endswith('.csv'), 'Only CSV files are supported'
 
+    if use_cache and pa is not None:
+        return read_cache(ensure_cache(filepath), columns, cities, date_from, date_to)
+
     df = pd.read_csv(filepath)
     df.fillna(0, inplace=True)
     #consider forward filling missing values, it will fill missing values with the most recent valid (non-null) value from the previous row.
     # df.fillna(method="ffill", inplace=True)  # Forward fill missing values
 
     df["date"] = pd.to_datetime(df["date"], format="%d-%m-%Y", dayfirst=True)
+
+    if cities is not None:
+        df = df[df['city'].isin(cities)]
+    if date_from is not None:
+        df = df[df['date'] >= date_from]
+    if date_to is not None:
+        df = df[df['date'] <= date_to]
+    if columns is not None:
+        df = df[columns]
     return df
+
+
+def parse_dates(dates: pd.Series) -> pd.Series:
+    """Parse DD-MM-YYYY strings, converting every distinct date only once."""
+    # Every city repeats the same dates, so a chunk has far fewer distinct dates than rows
+    codes, uniques = pd.factorize(dates)
+    parsed = pd.to_datetime(pd.Series(uniques), format="%d-%m-%Y")
+    return pd.Series(parsed.to_numpy()[codes], index=dates.index, name=dates.name)
+
+
+def load_data_chunks(filepath: str, chunksize: int = CHUNK_SIZE, float_dtype: str = 'float32',
+                     use_cache: bool = True) -> Iterator[pd.DataFrame]:
+    """Stream the CSV as typed chunks so memory is bounded by chunksize instead of file size.
+
+    Chunks have the same columns as load_data, with category city/country and
+    float_dtype measurements. Pass float_dtype='float64' where the exact CSV values matter.
+    An up-to-date Arrow cache is read instead of the CSV unless use_cache is False, but it is never built here.
+    """
+    assert filepath.endswith('.csv'), 'Only CSV files are supported'
+
+    if use_cache and pa is not None and cache_is_fresh(filepath):
+        dataset = open_cache(cache_path(filepath))
+        for batch in dataset.to_batches(columns=CSV_COLUMNS, batch_size=chunksize):
+            chunk = batch.to_pandas()
+            chunk = chunk.astype({'city': 'category', 'country': 'category'})
+            yield chunk.astype({column: float_dtype for column in MEASUREMENT_COLUMNS})
+        return
+
+    dtype = {'city': 'category', 'country': 'category', 'Latitude': 'float64', 'Longitude': 'float64', 'date': 'str'}
+    dtype.update({column: float_dtype for column in MEASUREMENT_COLUMNS})
+
+    for chunk in pd.read_csv(filepath, dtype=dtype, chunksize=chunksize):
+        chunk.fillna({column: 0 for column in MEASUREMENT_COLUMNS}, inplace=True)
+        chunk["date"] = parse_dates(chunk["date"])
+        yield chunk
+
+
+def cache_path(filepath: str) -> str:
+    return filepath[:-len('.csv')] + CACHE_SUFFIX
+
+
+def source_signature(filepath: str) -> dict:
+    stat = os.stat(filepath)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def cache_is_fresh(filepath: str) -> bool:
+    try:
+        with open(os.path.join(cache_path(filepath), CACHE_SOURCE_FILE)) as file:
+            return json.load(file) == source_signature(filepath)
+    except (OSError, ValueError):
+        return False
+
+
+def write_cache(filepath: str) -> None:
+    """Convert the CSV chunk by chunk into Arrow IPC files, one directory per city."""
+    schema = pa.schema([
+        ('city', pa.string()), ('country', pa.string()),
+        ('Latitude', pa.float64()), ('Longitude', pa.float64()),
+        ('date', pa.timestamp('ns')),
+        *[(column, pa.float64()) for column in MEASUREMENT_COLUMNS],
+    ])
+
+    def batches():
+        for chunk in load_data_chunks(filepath, float_dtype='float64', use_cache=False):
+            chunk = chunk.astype({'city': str, 'country': str})
+            yield from pa.Table.from_pandas(chunk, schema=schema, preserve_index=False).to_batches()
+
+    target = cache_path(filepath)
+    parent, name = os.path.split(os.path.abspath(target))
+    # Every writer gets its own directory, processes building the same cache at once don't touch each other's files
+    tmp_target = tempfile.mkdtemp(prefix=f'.{name}.', suffix='.tmp', dir=parent)
+    old_target = os.path.join(parent, f'.{name}.{uuid.uuid4().hex}.old')
+    try:
+        # Uncompressed IPC files can be memory-mapped and read without copying
+        ds.write_dataset(batches(), tmp_target, schema=schema, format='ipc',
+                         partitioning=ds.partitioning(pa.schema([('city', pa.string())]), flavor='hive'),
+                         existing_data_behavior='overwrite_or_ignore', max_partitions=1 << 20)
+        with open(os.path.join(tmp_target, CACHE_SOURCE_FILE), 'w') as file:
+            json.dump(source_signature(filepath), file)
+        # Move the previous cache aside rather than deleting it in place, the new one is then published with one rename
+        try:
+            os.rename(target, old_target)
+        except FileNotFoundError:
+            pass
+        try:
+            os.replace(tmp_target, target)
+        except OSError:
+            # Another writer published the same cache in between, theirs is as fresh as ours
+            if not cache_is_fresh(filepath):
+                raise
+    finally:
+        shutil.rmtree(tmp_target, ignore_errors=True)
+        shutil.rmtree(old_target, ignore_errors=True)
+
+
+def ensure_cache(filepath: str) -> 'ds.Dataset':
+    if not cache_is_fresh(filepath):
+        print(f"Building columnar cache for {filepath}")
+        write_cache(filepath)
+    return open_cache(cache_path(filepath))
+
+
+def open_cache(path: str) -> 'ds.Dataset':
+    return ds.dataset(path, format='ipc', filesystem=pafs.LocalFileSystem(use_mmap=True),
+                      partitioning=ds.HivePartitioning.discover(infer_dictionary=True),
+                      exclude_invalid_files=True, ignore_prefixes=['_', '.'])
+
+
+def read_cache(
+        dataset: 'ds.Dataset',
+        columns: Optional[list[str]] = None,
+        cities: Optional[list[str]] = None,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None) -> pd.DataFrame:
+    # City filters prune whole partitions, date filters are evaluated while scanning
+    filter = None
+    conditions = []
+    if cities is not None:
+        conditions.append(ds.field('city').isin(cities))
+    if date_from is not None:
+        conditions.append(ds.field('date') >= pa.scalar(pd.Timestamp(date_from), pa.timestamp('ns')))
+    if date_to is not None:
+        conditions.append(ds.field('date') <= pa.scalar(pd.Timestamp(date_to), pa.timestamp('ns')))
+    for condition in conditions:
+        filter = condition if filter is None else filter & condition
+
+    if columns is None:
+        # The partition column comes last in the dataset schema, restore the CSV column order
+        columns = CSV_COLUMNS
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
@@ -1,11 +1,66 @@
+import queue
 import sqlite3
+from contextlib import contextmanager
+from datetime import date, datetime
+from pathlib import Path
+from typing import Iterator, Union
 
-def create_connection(filename: str) -> sqlite3.Connection:
+# Bumped whenever the layout written by build_database.py changes, see migrate_database.py
+SCHEMA_VERSION = 2
+
+# Dates are stored as integer day numbers: days since 1970-01-01
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def create_connection(filename: str, check_same_thread: bool = True) -> sqlite3.Connection:
     assert filename.endswith('.db'), 'Error: Database file must have a .db extension'
     try:
-        connection = sqlite3.connect(filename)
+        connection = sqlite3.connect(filename, check_same_thread=check_same_thread)
         print(f"Connection to SQLite DB successful: {filename}")
         return connection
     except sqlite3.Error as error:
         print(f"Error: {error}")
-        return None
\ No newline at end of file
+        return None
+
+
+def to_day_number(day: Union[date, datetime]) -> int:
+    return day.toordinal() - EPOCH_ORDINAL
+
+
+def from_day_number(day_number: int) -> date:
+    return date.fromordinal(day_number + EPOCH_ORDINAL)
+
+
+def schema_version(connection: sqlite3.Connection) -> int:
+    """Return the schema version of a database, 0 for an empty one and 1 for databases from before versioning."""
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+    if version == 0 and connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'WeatherData'").fetchone():
+        return 1
+    return version
+
+
+class ConnectionPool:
+    """Fixed set of read-only SQLite connections shared by worker threads.
+
+    Each connection is used by one thread at a time, so several lookups can run in parallel.
+    """
+
+    def __init__(self, filename: str, size: int = 8):
+        assert filename.endswith('.db'), 'Error: Database file must have a .db extension'
+        uri = Path(filename).absolute().as_uri() + '?mode=ro'
+        self.size = size
+        self._connections = queue.Queue()
+        for _ in range(size):
+            self._connections.put(sqlite3.connect(uri, uri=True, check_same_thread=False))
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        connection = self._connections.get()
+        try:
+            yield connection
+        finally:
+            self._connections.put(connection)
+
+    def close(self) -> None:
+        for _ in range(self.size):
+            self._connections.get().close()
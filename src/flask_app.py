@@ -1,57 +1,146 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template, session, stream_with_context, g
 import argparse
-from db_utils import create_connection
-from chat_bot import get_assistant_query, fetch_temperature, respond_to_user, extract_city_date, response_messages, query_messages
+import logging
+import os
+import time
+import uuid
+from db_utils import create_connection, ConnectionPool
+from query_database import WeatherQueryService
+from chat_bot import (plan_queries, fetch_plan, answer_user, answer_user_stream, sse_event, system_prompt, LOG_LEVELS, LOG_FORMAT,
+                      STREAM_ERROR_MESSAGE)
+from conversation import ConversationStore
+from intent_parser import IntentParser
+from response_cache import ResponseCache
+from query_plan import QueryPlanExecutor, build_query_plan
+from api import api
+from metrics import REGISTRY, REQUEST_SECONDS, RENDER_SECONDS, ERRORS, cache_collector, start_profile, stop_profile
 
 app = Flask(__name__)
+# Signs the session cookie that carries the conversation id
+app.secret_key = os.getenv("SECRET_KEY") or os.urandom(24)
 
 # Initialize database connection globally
 parser = argparse.ArgumentParser(description="Query SQLite database")
 parser.add_argument("filename", help="The name of the SQLite database file")
+parser.add_argument("--max-turns", type=int, default=6, help="Turns of conversation history sent to the LLM per session")
+parser.add_argument("--max-tokens", type=int, default=3000, help="Approximate token budget of the prompt per session")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=5000)
+parser.add_argument("--no-debug", action="store_true", help="Run without the debugger and reloader, e.g. for benchmarks")
+parser.add_argument("--pool-size", type=int, default=8, help="Number of pooled read-only SQLite connections for lookups")
+parser.add_argument("--no-fast-path", action="store_true", help="Always let the LLM parse the question")
+parser.add_argument("--response-cache", metavar="PATH", help="SQLite file that keeps cached answers across restarts")
+parser.add_argument("--template-responses", action="store_true", help="Phrase standard answers locally instead of asking the LLM")
+parser.add_argument("--log-level", default="WARNING", choices=LOG_LEVELS, help="DEBUG logs every question's lookups and answer")
+parser.add_argument("--profile-dir", help="Allow profiling single requests with ?profile=1, their cProfile stats are written here")
 args = parser.parse_args()
-connection = create_connection(args.filename)
+logging.basicConfig(level=args.log_level, format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+# Shared by all request threads, the service serializes access to the connection
+connection = create_connection(args.filename, check_same_thread=False)
+query_service = WeatherQueryService(connection)
+# Cache misses are looked up in parallel on pooled read-only connections, outside the service's lock
+plan_executor = QueryPlanExecutor(ConnectionPool(args.filename, args.pool_size))
+# The JSON API under /api reads from the same read-only pool
+app.extensions['db_pool'] = plan_executor.pool
+app.register_blueprint(api)
+conversations = ConversationStore(system_prompt, max_turns=args.max_turns, max_tokens=args.max_tokens)
+# Cities are read once at startup, questions about cities added later simply go to the LLM
+intent_parser = None if args.no_fast_path else IntentParser.from_connection(connection)
+response_cache = ResponseCache(path=args.response_cache)
+REGISTRY.add_collector('caches', cache_collector({
+    'query': query_service.stats,
+    'response': response_cache.stats,
+    'intent_parser': lambda: intent_parser.stats() if intent_parser is not None else None,
+}))
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    if args.profile_dir and request.args.get('profile') == '1':
+        g.profiler = start_profile()
+
+
+@app.after_request
+def record_request(response):
+    # Streamed responses are timed until their headers are sent, the stream itself is in weather_llm_seconds
+    REQUEST_SECONDS.observe(time.perf_counter() - g.start, endpoint=request.endpoint or 'unknown', status=response.status_code)
+    if 'profiler' in g:
+        response.headers['X-Profile'] = stop_profile(g.pop('profiler'), args.profile_dir, request.endpoint or 'unknown')
+    return response
+
+
+def current_conversation():
+    if 'conversation_id' not in session:
+        session['conversation_id'] = uuid.uuid4().hex
+    return conversations.get(session['conversation_id'])
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         user_query = request.form['user_query']
-        assistant_query = get_assistant_query(user_query, query_messages)
-        daily_queries, max_time_span_param, min_time_span_param = extract_city_date(assistant_query)
-        connection = create_connection(args.filename)  
-        temp = []
-        if daily_queries is not None:
-            cities_daily = [city for city, _ in daily_queries]
-            date_objects_daily = [date for _, date in daily_queries]
-            query_type = 'daily'
-            temp = []
-            for city, date_object in zip(cities_daily, date_objects_daily):
-                temp.append(fetch_temperature(city, date_object, query_type, connection))
-                print(f'db_response (daily): {temp}')
-  
-        if max_time_span_param is not None:
-            city_max, date_from_object_max, date_to_object_max = max_time_span_param
-            print(f'city in max time span: {city_max}, date_from: {date_from_object_max}, date_to: {date_to_object_max}\n')
-            query_type = 'max_span'
-            temp = fetch_temperature(city_max, date_from_object_max, query_type, connection, date_to_object_max)
-            print(f'db_response: {temp}')
-
-        if min_time_span_param is not None:
-            city_min, date_from_object_min, date_to_object_min = min_time_span_param
-            query_type = 'min_span'
-            temp = fetch_temperature(city_min, date_from_object_min, query_type, connection, date_to_object_min)
-            print(f'db_response: {temp}')
-        print(f"Final temp data: {temp}")
-        final_response = respond_to_user(temp, response_messages, user_query)
-        print(f"Final assistant response: {final_response}")
-        return render_template('index.html', user_query=user_query, assistant_response=final_response)
+        conversation = current_conversation()
+        daily_queries, max_time_span_param, min_time_span_param = plan_queries(user_query, conversation.query_messages, intent_parser)
+        # All intents of the question are looked up in one parallel phase and answered in one LLM call
+        plan = build_query_plan(daily_queries, max_time_span_param, min_time_span_param)
+        temp = fetch_plan(plan, plan_executor, query_service)
+        logger.debug("Final temp data: %s", temp)
+        final_response = answer_user(plan, temp, conversation.response_messages, user_query,
+                                     response_cache, args.template_responses)
+        logger.debug("Final assistant response: %s", final_response)
+        with RENDER_SECONDS.time(kind='page'):
+            return render_template('index.html', user_query=user_query, assistant_response=final_response)
 
     return render_template('index.html')
 
 
+@app.route('/stream', methods=['POST'])
+def stream():
+    """Same answer as index(), sent as server-sent events while the LLM generates it."""
+    user_query = request.form['user_query']
+    conversation = current_conversation()
+
+    @stream_with_context
+    def generate():
+        # The status line is already sent, a failure can only be reported as an event
+        try:
+            daily_queries, max_time_span_param, min_time_span_param = plan_queries(user_query, conversation.query_messages, intent_parser)
+            plan = build_query_plan(daily_queries, max_time_span_param, min_time_span_param)
+            temp = fetch_plan(plan, plan_executor, query_service)
+            for piece in answer_user_stream(plan, temp, conversation.response_messages, user_query,
+                                            response_cache, args.template_responses):
+                yield sse_event('token', piece)
+        except Exception:
+            logger.exception("Error while streaming the answer to %r", user_query)
+            ERRORS.inc(stage='stream')
+            yield sse_event('error', {'message': STREAM_ERROR_MESSAGE})
+            return
+        yield sse_event('done', {})
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/stats')
+def stats():
+    return jsonify(query_cache=query_service.stats(),
+                   response_cache=response_cache.stats(),
+                   intent_parser=intent_parser.stats() if intent_parser is not None else None)
+
+
+@app.route('/metrics')
+def metrics():
+    """Counters and latency histograms in the Prometheus text format."""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 
 if __name__ == '__main__':
     try:
-        app.run(debug=True)
+        app.run(host=args.host, port=args.port, debug=not args.no_debug, threaded=True)
     finally:
         if connection:
             connection.close()
+        plan_executor.close()
+        plan_executor.pool.close()
+        response_cache.close()
@@ -0,0 +1,96 @@
+import argparse
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from data_utils import CSV_COLUMNS
+
+# Real cities first, so generated questions read naturally; further cities get synthetic names and places
+CITIES = [
+    ('Belgrade', 'Serbia', 44.80, 20.46), ('Zagreb', 'Croatia', 45.81, 15.98), ('Paris', 'France', 48.86, 2.35),
+    ('Berlin', 'Germany', 52.52, 13.40), ('Madrid', 'Spain', 40.42, -3.70), ('Rome', 'Italy', 41.90, 12.50),
+    ('London', 'United Kingdom', 51.51, -0.13), ('Vienna', 'Austria', 48.21, 16.37), ('Athens', 'Greece', 37.98, 23.73),
+    ('Stockholm', 'Sweden', 59.33, 18.07), ('Oslo', 'Norway', 59.91, 10.75), ('Helsinki', 'Finland', 60.17, 24.94),
+    ('Warsaw', 'Poland', 52.23, 21.01), ('Prague', 'Czechia', 50.08, 14.44), ('Budapest', 'Hungary', 47.50, 19.04),
+    ('Lisbon', 'Portugal', 38.72, -9.14), ('Dublin', 'Ireland', 53.35, -6.26), ('Istanbul', 'Turkey', 41.01, 28.98),
+    ('Cairo', 'Egypt', 30.04, 31.24), ('Nairobi', 'Kenya', -1.29, 36.82), ('Cape Town', 'South Africa', -33.92, 18.42),
+    ('New York', 'United States', 40.71, -74.01), ('Los Angeles', 'United States', 34.05, -118.24),
+    ('Chicago', 'United States', 41.88, -87.63), ('Toronto', 'Canada', 43.65, -79.38), ('Mexico City', 'Mexico', 19.43, -99.13),
+    ('Buenos Aires', 'Argentina', -34.60, -58.38), ('Sao Paulo', 'Brazil', -23.55, -46.63), ('Lima', 'Peru', -12.05, -77.04),
+    ('Tokyo', 'Japan', 35.68, 139.69), ('Seoul', 'South Korea', 37.57, 126.98), ('Beijing', 'China', 39.90, 116.41),
+    ('Mumbai', 'India', 19.08, 72.88), ('Bangkok', 'Thailand', 13.76, 100.50), ('Singapore', 'Singapore', 1.35, 103.82),
+    ('Sydney', 'Australia', -33.87, 151.21), ('Melbourne', 'Australia', -37.81, 144.96), ('Auckland', 'New Zealand', -36.85, 174.76),
+    ('Reykjavik', 'Iceland', 64.15, -21.94), ('Moscow', 'Russia', 55.76, 37.62),
+]
+
+
+def city_table(count: int, rng: np.random.Generator) -> list[tuple[str, str, float, float]]:
+    cities = CITIES[:count]
+    for index in range(len(cities), count):
+        cities.append((f'City {index:05d}', 'Synthetic', round(rng.uniform(-60, 70), 2), round(rng.uniform(-180, 180), 2)))
+    return cities
+
+
+def city_frame(city: tuple[str, str, float, float], dates: pd.DatetimeIndex, rng: np.random.Generator,
+               missing: float) -> pd.DataFrame:
+    """Daily weather of one city: a latitude-dependent seasonal cycle plus autocorrelated noise."""
+    name, country, lat, lon = city
+    days = len(dates)
+    mean = 30 - 0.4 * abs(lat)
+    amplitude = 0.28 * abs(lat) * (1 if lat >= 0 else -1)
+    # Warmest around the end of July in the northern hemisphere, the end of January in the southern
+    season = np.cos(2 * np.pi * (dates.dayofyear.to_numpy() - 200) / 365.25)
+    noise = np.empty(days)
+    shocks = rng.normal(0, 2.0, days)
+    noise[0] = shocks[0]
+    for day in range(1, days):
+        noise[day] = 0.7 * noise[day - 1] + shocks[day]
+    tavg = mean + amplitude * season + noise
+    spread = rng.uniform(2, 7, days)
+
+    df = pd.DataFrame({
+        'city': name,
+        'country': country,
+        'Latitude': lat,
+        'Longitude': lon,
+        'date': dates.strftime('%d-%m-%Y'),
+        'tavg': tavg.round(1),
+        'tmin': (tavg - spread).round(1),
+        'tmax': (tavg + spread * rng.uniform(0.8, 1.3, days)).round(1),
+        'wdir': rng.uniform(0, 360, days).round(0),
+        'wspd': rng.gamma(2.0, 5.0, days).round(1),
+        'pres': rng.normal(1013, 8, days).round(1),
+    }, columns=CSV_COLUMNS)
+    # Stations drop some wind and pressure readings, like the real dataset
+    for column in ('wdir', 'wspd', 'pres'):
+        df.loc[rng.random(days) < missing, column] = np.nan
+    return df
+
+
+def generate_csv(filepath: str, cities: int, date_from: datetime, date_to: datetime, seed: int = 0,
+                 missing: float = 0.02) -> int:
+    """Write a CSV in the load_data schema and return the number of rows, written one city at a time."""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(date_from, date_to, freq='D')
+    rows = 0
+    for index, city in enumerate(city_table(cities, rng)):
+        df = city_frame(city, dates, rng, missing)
+        df.to_csv(filepath, mode='w' if index == 0 else 'a', header=index == 0, index=False)
+        rows += len(df)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic weather CSV in the load_data schema")
+    parser.add_argument("csv_file", help="The name of the .csv file to write")
+    parser.add_argument("--cities", type=int, default=10, help="Number of cities")
+    parser.add_argument("--date-from", default="01-01-2000", help="First day, DD-MM-YYYY")
+    parser.add_argument("--date-to", default="31-12-2022", help="Last day, DD-MM-YYYY")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed, the same seed gives the same file")
+    parser.add_argument("--missing", type=float, default=0.02, help="Fraction of missing wind and pressure readings")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    rows = generate_csv(args.csv_file, args.cities, datetime.strptime(args.date_from, '%d-%m-%Y'),
+                        datetime.strptime(args.date_to, '%d-%m-%Y'), args.seed, args.missing)
+    print(f"Wrote {rows} rows for {args.cities} cities to {args.csv_file} in {time.perf_counter() - start:.2f}s")
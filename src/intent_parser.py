@@ -0,0 +1,163 @@
+import difflib
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Optional, Tuple, List
+
+# Same shape as chat_bot.extract_city_date: (daily queries, max span, min span)
+ParsedQuery = Tuple[List[Tuple[str, datetime]], Optional[Tuple[str, datetime, datetime]], Optional[Tuple[str, datetime, datetime]]]
+
+MONTHS = {name: number for number, names in enumerate([
+    ('january', 'jan'), ('february', 'feb'), ('march', 'mar'), ('april', 'apr'), ('may',), ('june', 'jun'),
+    ('july', 'jul'), ('august', 'aug'), ('september', 'sep', 'sept'), ('october', 'oct'), ('november', 'nov'),
+    ('december', 'dec')], start=1) for name in names}
+MONTH_PATTERN = '|'.join(sorted(MONTHS, key=len, reverse=True))
+
+# Numeric dates are day first, like the DD-MM-YYYY format the bot uses everywhere else
+DATE_PATTERNS = [
+    (re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b"), lambda m: (m[1], m[2], m[3])),
+    (re.compile(r"\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})\b"), lambda m: (m[3], m[2], m[1])),
+    (re.compile(rf"\b(\d{{1,2}})(?:st|nd|rd|th)?\s+(?:of\s+)?({MONTH_PATTERN})\.?,?\s+(\d{{4}})\b", re.IGNORECASE),
+     lambda m: (m[3], MONTHS[m[2].lower()], m[1])),
+    (re.compile(rf"\b({MONTH_PATTERN})\.?\s+(\d{{1,2}})(?:st|nd|rd|th)?,?\s+(\d{{4}})\b", re.IGNORECASE),
+     lambda m: (m[3], MONTHS[m[1].lower()], m[2])),
+]
+
+MAX_WORDS = {'max', 'maximum', 'highest', 'hottest', 'warmest', 'peak'}
+MIN_WORDS = {'min', 'minimum', 'lowest', 'coldest', 'coolest'}
+# Questions the fast path cannot answer correctly, these always go to the LLM
+UNSUPPORTED_WORDS = {'average', 'mean', 'wind', 'pressure', 'rain', 'snow', 'humidity', 'forecast', 'tomorrow',
+                     'today', 'yesterday', 'week', 'month', 'year', 'not', 'without', 'except', 'difference'}
+# A comparison's direction matters for the answer, so these only pass with several cities on one day,
+# whose answers response_cache never templates or caches
+COMPARISON_WORDS = {'higher', 'lower', 'warmer', 'colder', 'hotter', 'cooler'}
+STOP_WORDS = {'what', 'was', 'the', 'temperature', 'temp', 'in', 'on', 'from', 'to', 'and', 'between', 'of',
+              'compare', 'which', 'city', 'had', 'how', 'hot', 'cold', 'it', 'is',
+              'were', 'there', 'tell', 'me', 'please', 'until', 'till', 'through', 'vs', 'versus', 'or', 'a'} \
+             | MAX_WORDS | MIN_WORDS
+
+
+class CityTrie:
+    """Word-level trie of city names, finds the longest city name at each position of a query."""
+
+    def __init__(self, cities: list[str]):
+        self.root = {}
+        for city in cities:
+            node = self.root
+            for word in city.lower().split():
+                node = node.setdefault(word, {})
+            node[None] = city
+        self.single_words = {city.lower(): city for city in cities if len(city.split()) == 1}
+
+    def find(self, words: list[str]) -> Tuple[list[str], list[str]]:
+        """Return the cities found in words and the words that are not part of a city name."""
+        cities, rest = [], []
+        position = 0
+        while position < len(words):
+            node, match, end = self.root, None, position
+            for index in range(position, len(words)):
+                node = node.get(words[index])
+                if node is None:
+                    break
+                if None in node:
+                    match, end = node[None], index + 1
+            if match is not None:
+                cities.append(match)
+                position = end
+            else:
+                rest.append(words[position])
+                position += 1
+        return cities, rest
+
+    def fuzzy(self, word: str) -> Optional[str]:
+        match = difflib.get_close_matches(word, self.single_words, n=1, cutoff=0.85)
+        return self.single_words[match[0]] if match else None
+
+
+class IntentParser:
+    """Deterministic fast path for simple questions that skips the LLM call of get_assistant_query.
+
+    parse() returns the same structures as extract_city_date, or None when the question is not
+    clearly a daily/max/min lookup, in which case the caller falls back to the LLM.
+    """
+
+    def __init__(self, cities: list[str]):
+        self.trie = CityTrie(cities)
+        self.hits = 0
+        self.fallbacks = 0
+        self.parse_seconds = 0.0
+        self.llm_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_connection(cls, connection: sqlite3.Connection) -> 'IntentParser':
+        return cls([city for city, in connection.execute('SELECT city FROM Cities')])
+
+    def parse(self, user_query: str) -> Optional[ParsedQuery]:
+        start = time.perf_counter()
+        parsed = self._parse(user_query)
+        with self._lock:
+            self.parse_seconds += time.perf_counter() - start
+            if parsed is not None:
+                self.hits += 1
+        return parsed
+
+    def record_fallback(self, llm_seconds: float) -> None:
+        """Report how long the LLM took for a question parse() could not handle."""
+        with self._lock:
+            self.fallbacks += 1
+            self.llm_seconds += llm_seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.fallbacks
+            average_llm = self.llm_seconds / self.fallbacks if self.fallbacks else 0.0
+            return {
+                'hits': self.hits,
+                'fallbacks': self.fallbacks,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'average_llm_seconds': average_llm,
+                # Every hit saved one LLM round-trip, minus the time spent parsing
+                'seconds_saved': self.hits * average_llm - self.parse_seconds,
+            }
+
+    def _parse(self, user_query: str) -> Optional[ParsedQuery]:
+        dates = []
+        text = user_query
+        for pattern, fields in DATE_PATTERNS:
+            for match in pattern.finditer(text):
+                try:
+                    year, month, day = (int(value) for value in fields(match))
+                    dates.append((match.start(), datetime(year, month, day)))
+                except ValueError:
+                    return None
+            text = pattern.sub(' ', text)
+        dates = [date for _, date in sorted(dates, key=lambda item: item[0])]
+
+        words = re.findall(r"\w+", text.lower())
+        if UNSUPPORTED_WORDS.intersection(words):
+            return None
+        cities, rest = self.trie.find(words)
+        unknown = [word for word in rest if word not in STOP_WORDS | COMPARISON_WORDS and not word.isdigit()]
+        if not cities and len(unknown) == 1:
+            city = self.trie.fuzzy(unknown[0])
+            if city is not None:
+                cities, unknown = [city], []
+        # Anything left over may change the meaning of the question
+        if not cities or unknown:
+            return None
+
+        wants_max = bool(MAX_WORDS.intersection(words))
+        wants_min = bool(MIN_WORDS.intersection(words))
+        compares = bool(COMPARISON_WORDS.intersection(rest))
+        if len(dates) == 1 and not wants_max and not wants_min:
+            cities = list(dict.fromkeys(cities))
+            if compares and len(cities) < 2:
+                return None
+            return [(city, dates[0]) for city in cities], None, None
+        if len(dates) == 2 and len(cities) == 1 and wants_max != wants_min and dates[0] <= dates[1]:
+            span = (cities[0], dates[0], dates[1])
+            return ([], span, None) if wants_max else ([], None, span)
+        return None
@@ -0,0 +1,186 @@
+import bisect
+import cProfile
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional
+
+# In-process counters and latency histograms of the hot paths, rendered in the Prometheus text format
+# by the apps' /metrics endpoints. Kept dependency-free: a scrape only reads a few dicts.
+
+# Seconds, from sub-millisecond lookups up to slow LLM completions
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels: TOKENS.inc(120, kind='prompt')."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(str(labels[name]) for name in self.labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{format_labels(self.labels, key)} {format_value(value)}'
+
+
+class Histogram:
+    """Cumulative latency histogram, optionally split by labels: DB_SECONDS.observe(0.002, query='plan')."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}   # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += seconds
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        series = self._series.get(tuple(str(labels[name]) for name in self.labels))
+        return sum(series[:-1]) if series else 0
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), values[:-1]):
+                cumulative += count
+                le = f'le="{bound if bound == "+Inf" else format_value(bound)}"'
+                yield f'{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labels, key)} {format_value(values[-1])}'
+            yield f'{self.name}_count{format_labels(self.labels, key)} {cumulative}'
+
+
+class Registry:
+    """All metrics of the process, plus collectors that read counters other objects already keep."""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = {}
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def add_collector(self, name: str, collect: Callable[[], Iterable[str]]) -> None:
+        """collect() yields complete exposition lines at scrape time, a collector added again under the same name replaces it."""
+        self._collectors[name] = collect
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        for collect in list(self._collectors.values()):
+            lines.extend(collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+LLM_SECONDS = REGISTRY.histogram('weather_llm_seconds', 'Duration of LLM calls', ('call',))
+LLM_FIRST_TOKEN_SECONDS = REGISTRY.histogram('weather_llm_first_token_seconds', 'Time until a streamed LLM answer sends its first piece')
+LLM_TOKENS = REGISTRY.counter('weather_llm_tokens_total', 'Tokens used by LLM calls as reported by the API', ('kind',))
+EXTRACT_SECONDS = REGISTRY.histogram('weather_extract_seconds', 'Duration of turning a question into queries without the LLM', ('method',))
+DB_SECONDS = REGISTRY.histogram('weather_db_seconds', 'Duration of database lookups', ('query',))
+RENDER_SECONDS = REGISTRY.histogram('weather_render_seconds', 'Duration of rendering answers and pages', ('kind',))
+REQUEST_SECONDS = REGISTRY.histogram('weather_request_seconds', 'Duration of HTTP requests', ('endpoint', 'status'))
+ERRORS = REGISTRY.counter('weather_errors_total', 'Failures answered as missing data (fetch) or as an error event (stream)', ('stage',))
+
+
+def record_usage(usage) -> None:
+    """Count the tokens of an OpenAI response's usage block, the API may leave it out."""
+    if usage is not None:
+        LLM_TOKENS.inc(usage.prompt_tokens or 0, kind='prompt')
+        LLM_TOKENS.inc(usage.completion_tokens or 0, kind='completion')
+
+
+def cache_collector(caches: dict[str, Callable[[], Optional[dict]]]) -> Callable[[], Iterator[str]]:
+    """Expose the hits and misses that caches count in their stats() as weather_cache_{hits,misses}_total{cache=...}.
+
+    The intent parser counts fallbacks to the LLM, those are its misses.
+    """
+    def collect() -> Iterator[str]:
+        stats = {name: func() for name, func in caches.items()}
+        stats = {name: values for name, values in stats.items() if values is not None}
+        for result, fields in (('hits', ('hits',)), ('misses', ('misses', 'fallbacks'))):
+            yield f'# HELP weather_cache_{result}_total Cache {result} by cache'
+            yield f'# TYPE weather_cache_{result}_total counter'
+            for name, values in stats.items():
+                value = next((values[field] for field in fields if field in values), 0)
+                yield f'weather_cache_{result}_total{format_labels(("cache",), (name,))} {value}'
+    return collect
+
+
+def start_profile() -> cProfile.Profile:
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler: cProfile.Profile, directory: str, name: str) -> str:
+    """Stop profiling and write the stats to <directory>/<time>-<name>.prof, readable with pstats or snakeviz."""
+    profiler.disable()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}-{name}.prof")
+    profiler.dump_stats(path)
+    return path
@@ -0,0 +1,142 @@
+import sqlite3
+import time
+from datetime import date
+from typing import Callable
+from build_database import create_tables, create_indexes, refresh_rollups
+from db_utils import SCHEMA_VERSION, schema_version
+from query_database import (TEMPERATURE_IN_CITY_SQL, SERIES_IN_CITY_SQL, SERIES_BUCKETED_SQL, SERIES_BUCKETS,
+                            CITY_DATE_RANGE_SQL, CITY_COMPARISON_SQL, BATCH_SQL, WeatherQueryService, span_extreme_sql)
+import argparse
+
+
+# v1 rows that cannot be keyed in v2: no city, or a date SQLite cannot parse
+V1_INVALID_ROWS = 'w.city_id IS NULL OR c.id IS NULL OR julianday(w.date) IS NULL'
+
+
+def migrate_v1_to_v2(connection: sqlite3.Connection) -> None:
+    """Rebuild WeatherData as a WITHOUT ROWID table keyed on (city_id, day number).
+
+    Duplicate cities and duplicate (city, date) rows left by older appending builds are
+    collapsed on the way, keeping the most recently inserted measurement. Rows without a
+    city or a valid date are skipped and reported.
+    """
+    cursor = connection.cursor()
+    cursor.execute('ALTER TABLE WeatherData RENAME TO WeatherData_v1')
+    for index in ('idx_city_id', 'idx_city_date', 'idx_city_name'):
+        cursor.execute(f'DROP INDEX IF EXISTS {index}')
+    create_tables(cursor, set_version=False)
+
+    skipped = cursor.execute(f"""
+        SELECT COUNT(*) FROM WeatherData_v1 w LEFT JOIN Cities c ON c.id = w.city_id
+        WHERE {V1_INVALID_ROWS}""").fetchone()[0]
+    if skipped:
+        print(f"Skipping {skipped} rows without a city or a valid date")
+
+    cursor.execute(f"""
+        INSERT INTO WeatherData (city_id, date, temperature_avg, temperature_min, temperature_max, wind_direction, wind_speed, pressure)
+        SELECT k.id, CAST(julianday(w.date) - 2440587.5 AS INTEGER),
+               w.temperature_avg, w.temperature_min, w.temperature_max, w.wind_direction, w.wind_speed, w.pressure
+        FROM WeatherData_v1 w
+        JOIN Cities c ON c.id = w.city_id
+        JOIN (SELECT city, MIN(id) AS id FROM Cities GROUP BY city) k ON k.city = c.city
+        WHERE w.id IN (SELECT MAX(w.id) FROM WeatherData_v1 w LEFT JOIN Cities c ON c.id = w.city_id
+                       WHERE NOT ({V1_INVALID_ROWS})
+                       GROUP BY c.city, CAST(julianday(w.date) - 2440587.5 AS INTEGER))
+        ORDER BY 1, 2""")
+    cursor.execute('DELETE FROM Cities WHERE id NOT IN (SELECT MIN(id) FROM Cities GROUP BY city)')
+    create_indexes(cursor)
+    cursor.execute('DROP TABLE WeatherData_v1')
+    refresh_rollups(cursor)
+    cursor.execute('PRAGMA user_version = 2')
+
+
+MIGRATIONS = {1: migrate_v1_to_v2}
+
+
+def run_in_transaction(migration: Callable[[sqlite3.Connection], None], connection: sqlite3.Connection) -> None:
+    """Run a migration, including its DDL and user_version, in one transaction.
+
+    The sqlite3 module commits before DDL statements on its own, so the transaction is managed
+    explicitly: an error or a Ctrl-C rolls the file back to the old schema with its data intact.
+    """
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            migration(connection)
+        except BaseException:
+            # Some errors (e.g. a full disk) already rolled the transaction back
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+    finally:
+        connection.isolation_level = isolation_level
+
+
+def migrate(connection: sqlite3.Connection) -> None:
+    version = schema_version(connection)
+    if version == 0:
+        print("Database is empty, build_database.py creates the current schema")
+        return
+    while version < SCHEMA_VERSION:
+        start = time.perf_counter()
+        run_in_transaction(MIGRATIONS[version], connection)
+        print(f"Migrated schema v{version} -> v{version + 1} in {time.perf_counter() - start:.2f}s")
+        version = schema_version(connection)
+    print(f"Schema is at v{version}")
+
+
+def query_plans(connection: sqlite3.Connection) -> dict[str, list[str]]:
+    """EXPLAIN QUERY PLAN of every statement issued by query_database.py."""
+    day = 18000
+    queries = {
+        'query_temperature_in_city': (TEMPERATURE_IN_CITY_SQL, ('Belgrade', day)),
+        # A span with partial months, whole months and whole years exercises every branch
+        'query_max_temperature_in_time_span_per_city': span_extreme_sql('MAX', 'temperature_max', 'Belgrade', date(2018, 11, 15), date(2021, 2, 10)),
+        'query_min_temperature_in_time_span_per_city': span_extreme_sql('MIN', 'temperature_min', 'Belgrade', date(2018, 11, 15), date(2021, 2, 10)),
+        'query_temperature_series': (SERIES_IN_CITY_SQL, ('Belgrade', day, day + 365)),
+        **{f'query_temperature_series ({resolution})': (SERIES_BUCKETED_SQL.format(bucket=bucket), ('Belgrade', day, day + 365))
+           for resolution, bucket in SERIES_BUCKETS.items()},
+        'query_date_range': (CITY_DATE_RANGE_SQL, ('Belgrade',)),
+        'query_city_comparison': (CITY_COMPARISON_SQL, (day, 'Zagreb', day, 'Belgrade')),
+        'query_temperatures_batch': (BATCH_SQL.format(values='(?, ?, ?, ?, ?, ?), (?, ?, ?, ?, ?, ?)'),
+                                     (0, 'daily', 'day', 'Belgrade', day, day, 1, 'max', 'days', 'Zagreb', day, day + 9)),
+        'WeatherQueryService.DAILY_SQL': (WeatherQueryService.DAILY_SQL, (1, day)),
+        'WeatherQueryService.SERIES_SQL': (WeatherQueryService.SERIES_SQL, (1,)),
+    }
+    return {name: [row[-1] for row in connection.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+            for name, (sql, params) in queries.items()}
+
+
+def check_query_plans(connection: sqlite3.Connection) -> bool:
+    ok = True
+    for name, plan in query_plans(connection).items():
+        # "SCAN <table>" without "USING ... INDEX" is a full table scan, scanning the batch's VALUES list is expected
+        full_scans = [step for step in plan if step.startswith('SCAN') and 'USING' not in step
+                      and 'CONSTANT ROW' not in step and step != 'SCAN parts']
+        ok = ok and not full_scans
+        print(f"{'FULL SCAN' if full_scans else 'ok':9} {name}")
+        for step in plan:
+            print(f"          {step}")
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Upgrade a .db file built by an older build_database.py in place")
+    parser.add_argument("db_file", help="The name of the .db file to migrate")
+    parser.add_argument("--check", action="store_true", help="Verify with EXPLAIN QUERY PLAN that every query uses an index")
+    parser.add_argument("--no-vacuum", action="store_true", help="Skip reclaiming the space of the old tables")
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(args.db_file)
+    version = schema_version(connection)
+    migrate(connection)
+    if version < SCHEMA_VERSION and not args.no_vacuum:
+        connection.execute('VACUUM')
+
+    ok = check_query_plans(connection) if args.check else True
+    connection.close()
+    if not ok:
+        raise SystemExit(1)
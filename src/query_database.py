@@ -1,21 +1,95 @@
+import logging
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from math import inf
+from typing import Callable, Iterator, NamedTuple, Optional
+from db_utils import to_day_number, from_day_number
+
+logger = logging.getLogger(__name__)
+
+# Dates are stored as day numbers (see db_utils.to_day_number), the statements below take them as parameters.
+# migrate_database.py --check runs EXPLAIN QUERY PLAN on each of them to make sure they stay index searches.
+TEMPERATURE_IN_CITY_SQL = """
+    SELECT WeatherData.temperature_avg
+    FROM WeatherData
+    JOIN Cities ON WeatherData.city_id = Cities.id
+    WHERE Cities.city = ?
+    AND WeatherData.date = ?
+    """
+
+SPAN_DAYS_SQL = 'SELECT {aggregate}({column}) AS value FROM WeatherData WHERE city_id = (SELECT id FROM Cities WHERE city = ?) AND date BETWEEN ? AND ?'
+SPAN_MONTHS_SQL = 'SELECT {aggregate}({column}) AS value FROM MonthlyStats WHERE city_id = (SELECT id FROM Cities WHERE city = ?) AND month BETWEEN ? AND ?'
+SPAN_YEARS_SQL = 'SELECT {aggregate}({column}) AS value FROM YearlyStats WHERE city_id = (SELECT id FROM Cities WHERE city = ?) AND year BETWEEN ? AND ?'
+
+SERIES_IN_CITY_SQL = """
+    SELECT date, temperature_avg, temperature_min, temperature_max
+    FROM WeatherData
+    WHERE city_id = (SELECT id FROM Cities WHERE city = ?)
+    AND date BETWEEN ? AND ?
+    ORDER BY date
+    """
+
+# Weeks start on Monday (day 0, 1970-01-01, was a Thursday), months on the 1st
+SERIES_BUCKETS = {
+    'weekly': 'date - ((date + 3) % 7 + 7) % 7',
+    'monthly': "CAST(julianday(date * 86400, 'unixepoch', 'start of month') - 2440587.5 AS INTEGER)",
+}
+SERIES_RESOLUTIONS = ('daily', *SERIES_BUCKETS)
+SERIES_BUCKETED_SQL = """
+    SELECT {bucket} AS bucket, AVG(temperature_avg), MIN(temperature_min), MAX(temperature_max)
+    FROM WeatherData
+    WHERE city_id = (SELECT id FROM Cities WHERE city = ?)
+    AND date BETWEEN ? AND ?
+    GROUP BY bucket
+    ORDER BY bucket
+    """
+
+CITY_DATE_RANGE_SQL = """
+    SELECT
+        (SELECT MIN(date) FROM WeatherData WHERE city_id = Cities.id),
+        (SELECT MAX(date) FROM WeatherData WHERE city_id = Cities.id)
+    FROM Cities
+    WHERE city = ?
+    """
+
+SeriesRow = tuple[date, Optional[float], Optional[float], Optional[float]]
+
+CITY_COMPARISON_SQL = """
+    SELECT
+        c1.city AS city1_alias,
+        c2.city AS city2_alias,
+        w1.temperature_max AS temperature1_alias,
+        w2.temperature_max AS temperature2_alias,
+            CASE
+                WHEN w1.temperature_max > w2.temperature_max THEN w1.temperature_max
+                WHEN w2.temperature_max > w1.temperature_max THEN w2.temperature_max
+                ELSE 'Both cities had the same temperature'
+            END AS higher_temp
+    FROM
+        Cities c1
+    JOIN
+        WeatherData w1 ON w1.city_id = c1.id AND w1.date = ?
+    JOIN
+        Cities c2 ON c2.city = ?
+    JOIN
+        WeatherData w2 ON w2.city_id = c2.id AND w2.date = ?
+    WHERE
+        c1.city = ?
+    """
+
 
 def query_temperature_in_city(
         city: str,
         date: datetime,
         connection: sqlite3.Connection) -> float:
     assert isinstance(date, datetime), "date must be datetime object"
-    date_str = date.strftime("%Y-%m-%d")
-    print(date_str)
+    logger.debug('temperature in %s on %s', city, date)
     cursor = connection.cursor()
-    cursor.execute("""
-        SELECT WeatherData.temperature_avg
-        FROM WeatherData
-        JOIN Cities ON WeatherData.city_id = Cities.id
-        WHERE Cities.city = ?
-        AND WeatherData.date = ?
-        """, (city, date_str))
+    cursor.execute(TEMPERATURE_IN_CITY_SQL, (city, to_day_number(date)))
     temperature = cursor.fetchone()
     if temperature:
         return temperature[0]
@@ -29,20 +103,7 @@ def query_max_temperature_in_time_span_per_city(
         connection: sqlite3.Connection) -> float:
     assert isinstance(date_from, datetime) and isinstance(date_to, datetime), "dates must be a datetime objects"
     assert date_from <= date_to, "date_from needs to be before the date date_to"
-    date_from_str = date_from.strftime("%Y-%m-%d")
-    date_to_str = date_to.strftime("%Y-%m-%d")
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT MAX(WeatherData.temperature_max)
-        FROM WeatherData
-        JOIN Cities ON WeatherData.city_id = Cities.id
-        WHERE Cities.city = ?
-        AND WeatherData.date BETWEEN ? AND ?
-        """, (city, date_from_str, date_to_str))
-    max_temperature = cursor.fetchone()[0]
-    if max_temperature and max_temperature[0] is not None:
-        return max_temperature[0]
-    return None
+    return query_span_extreme('MAX', 'temperature_max', city, date_from, date_to, connection)
 
 
 def query_min_temperature_in_time_span_per_city(
@@ -52,51 +113,453 @@ def query_min_temperature_in_time_span_per_city(
         connection: sqlite3.Connection) -> float:
     assert isinstance(date_to, datetime) and isinstance(date_from, datetime), "dates must be datetime objects"
     assert date_from <= date_to, "date_from needs to be before, or the same day as date_to"
-    date_from_str = date_from.strftime("%Y-%m-%d")
-    date_to_str = date_to.strftime("%Y-%m-%d")
+    return query_span_extreme('MIN', 'temperature_min', city, date_from, date_to, connection)
+
+
+def split_span(date_from: date, date_to: date) -> tuple[list[tuple[date, date]], list[tuple[str, str]], list[tuple[int, int]]]:
+    """Split an inclusive date range into partial-month day ranges, whole-month ranges and whole-year ranges."""
+    first_full_month = date_from if date_from.day == 1 else _add_months(date_from.replace(day=1), 1)
+    next_month = _add_months(date_to.replace(day=1), 1)
+    end_full_months = next_month if date_to == next_month - timedelta(days=1) else date_to.replace(day=1)
+    if first_full_month >= end_full_months:
+        return [(date_from, date_to)], [], []
+
+    days = []
+    if date_from < first_full_month:
+        days.append((date_from, first_full_month - timedelta(days=1)))
+    if end_full_months <= date_to:
+        days.append((end_full_months, date_to))
+
+    # Whole months in [first_full_month, end_full_months), the whole years among them go to YearlyStats
+    last_full_month = _add_months(end_full_months, -1)
+    first_full_year = first_full_month.year if first_full_month.month == 1 else first_full_month.year + 1
+    last_full_year = last_full_month.year if last_full_month.month == 12 else last_full_month.year - 1
+    if first_full_year > last_full_year:
+        return days, [(first_full_month.strftime('%Y-%m'), last_full_month.strftime('%Y-%m'))], []
+
+    months = []
+    if first_full_month.year < first_full_year:
+        months.append((first_full_month.strftime('%Y-%m'), f'{first_full_month.year}-12'))
+    if last_full_month.year > last_full_year:
+        months.append((f'{last_full_month.year}-01', last_full_month.strftime('%Y-%m')))
+    return days, months, [(first_full_year, last_full_year)]
+
+
+def _add_months(month_start: date, months: int) -> date:
+    index = month_start.year * 12 + month_start.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def span_extreme_sql(aggregate: str, column: str, city: str, date_from: date, date_to: date) -> tuple[str, list]:
+    days, months, years = split_span(date_from, date_to)
+    parts, params = [], []
+    for first, last in days:
+        parts.append(SPAN_DAYS_SQL.format(aggregate=aggregate, column=column))
+        params += [city, to_day_number(first), to_day_number(last)]
+    for first, last in months:
+        parts.append(SPAN_MONTHS_SQL.format(aggregate=aggregate, column=column))
+        params += [city, first, last]
+    for first, last in years:
+        parts.append(SPAN_YEARS_SQL.format(aggregate=aggregate, column=column))
+        params += [city, first, last]
+    return f'SELECT {aggregate}(value) FROM ({" UNION ALL ".join(parts)})', params
+
+
+def query_span_extreme(
+        aggregate: str,
+        column: str,
+        city: str,
+        date_from: datetime,
+        date_to: datetime,
+        connection: sqlite3.Connection) -> Optional[float]:
+    """MIN/MAX of a column over a date range, reading whole months and years from the rollup tables.
+
+    Only the partial months at both ends are read from WeatherData, so the number of rows
+    touched no longer grows with the length of the span.
+    """
     cursor = connection.cursor()
-    cursor.execute("""
-        SELECT MIN(WeatherData.temperature_min)
-        FROM WeatherData
-        JOIN Cities ON WeatherData.city_id = Cities.id
-        WHERE Cities.city = ?
-        AND WeatherData.date BETWEEN ? AND ?
-        """, (city, date_from_str, date_to_str))
-    min_temperature = cursor.fetchone()[0]
-    if min_temperature and min_temperature[0] is not None:
-        return min_temperature[0]
+    cursor.execute(*span_extreme_sql(aggregate, column, city, date_from.date(), date_to.date()))
+    temperature = cursor.fetchone()
+    if temperature and temperature[0] is not None:
+        return temperature[0]
     return None
 
 
 def query_city_comparison(city1: str, city2: str, date: datetime, connection: sqlite3.Connection) -> str:
     assert isinstance(date, datetime), "date must be an datetime object"
-    date_str = date.strftime("%Y-%m-%d")
+    day = to_day_number(date)
     cursor = connection.cursor()
-    cursor.execute("""
-        SELECT 
-            c1.city AS city1_alias, 
-            c2.city AS city2_alias, 
-            w1.temperature_max AS temperature1_alias, 
-            w2.temperature_max AS temperature2_alias,
-                CASE
-                    WHEN w1.temperature_max > w2.temperature_max THEN w1.temperature_max
-                    WHEN w2.temperature_max > w1.temperature_max THEN w2.temperature_max
-                    ELSE 'Both cities had the same temperature'
-                END AS higher_temp
-        FROM
-            WeatherData w1    
-        JOIN
-            Cities c1 ON w1.city_id = c1.id
-        JOIN
-            WeatherData w2 ON w2.city_id = c2.id
-        JOIN
-            Cities c2 ON w2.city_id = c2.id
-        WHERE
-            w1.date = ? AND w2.date = ?
-            AND c1.city = ? AND c2.city = ? 
-        """, (date_str, date_str, city1, city2))
+    cursor.execute(CITY_COMPARISON_SQL, (day, city2, day, city1))
     result = cursor.fetchone()
     if result:
         _, _, _, _, higher_temp = result
         return higher_temp if higher_temp != 'Both cities had the same temperature' else '0'
     return None
+
+
+def query_temperature_series(
+        city: str,
+        date_from: datetime,
+        date_to: datetime,
+        connection: sqlite3.Connection,
+        resolution: str = 'daily') -> list[SeriesRow]:
+    """(date, avg, min, max) rows of a city in an inclusive date range, oldest first.
+
+    With a 'weekly' or 'monthly' resolution every row aggregates one week (starting Monday) or month,
+    dated by its first day: the average of the daily averages, the lowest minimum and the highest maximum.
+    """
+    return list(iter_temperature_series(city, date_from, date_to, connection, resolution))
+
+
+def iter_temperature_series(
+        city: str,
+        date_from: datetime,
+        date_to: datetime,
+        connection: sqlite3.Connection,
+        resolution: str = 'daily') -> Iterator[SeriesRow]:
+    """Same as query_temperature_series, reading the rows from the cursor as they are consumed."""
+    assert isinstance(date_from, datetime) and isinstance(date_to, datetime), "dates must be datetime objects"
+    assert date_from <= date_to, "date_from needs to be before, or the same day as date_to"
+    assert resolution in SERIES_RESOLUTIONS, f"resolution must be one of {', '.join(SERIES_RESOLUTIONS)}"
+    sql = SERIES_IN_CITY_SQL if resolution == 'daily' else SERIES_BUCKETED_SQL.format(bucket=SERIES_BUCKETS[resolution])
+    cursor = connection.cursor()
+    cursor.execute(sql, (city, to_day_number(date_from), to_day_number(date_to)))
+    for day, *temperatures in cursor:
+        yield (from_day_number(day), *temperatures)
+
+
+def query_date_range(city: str, connection: sqlite3.Connection) -> Optional[tuple[date, date]]:
+    """First and last day with data for a city, None for an unknown city."""
+    row = connection.execute(CITY_DATE_RANGE_SQL, (city,)).fetchone()
+    if row and row[0] is not None:
+        return from_day_number(row[0]), from_day_number(row[1])
+    return None
+
+
+def series_buckets(date_from: datetime, date_to: datetime, resolution: str) -> int:
+    """Number of rows a series can have at a resolution, counting the partial weeks or months at both ends."""
+    if resolution == 'daily':
+        return (date_to - date_from).days + 1
+    if resolution == 'weekly':
+        first_monday = date_from - timedelta(days=date_from.weekday())
+        last_monday = date_to - timedelta(days=date_to.weekday())
+        return (last_monday - first_monday).days // 7 + 1
+    return (date_to.year - date_from.year) * 12 + date_to.month - date_from.month + 1
+
+
+def series_resolution(date_from: datetime, date_to: datetime, max_points: int) -> Optional[str]:
+    """The finest resolution that keeps a date range within max_points rows.
+
+    None when even monthly rows would exceed it, the daily rows then need lttb(rows, max_points).
+    """
+    for resolution in SERIES_RESOLUTIONS:
+        if series_buckets(date_from, date_to, resolution) <= max_points:
+            return resolution
+    return None
+
+
+def lttb(rows: list[SeriesRow], points: int) -> list[SeriesRow]:
+    """Largest-Triangle-Three-Buckets downsampling of daily rows on their average temperature.
+
+    Keeps the first and last row and, from each of the points - 2 buckets in between, the row forming
+    the largest triangle with the row kept before it and the mean of the next bucket, which preserves
+    the peaks and dips a plot of the full series would show.
+    """
+    assert points >= 3, "points must be at least 3"
+    rows = [row for row in rows if row[1] is not None]
+    if points >= len(rows):
+        return rows
+    x = [row[0].toordinal() for row in rows]
+    y = [row[1] for row in rows]
+    bucket_size = (len(rows) - 2) / (points - 2)
+    kept = [rows[0]]
+    previous = 0
+    for bucket in range(points - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        next_end = min(int((bucket + 2) * bucket_size) + 1, len(rows))
+        if bucket == points - 3:
+            next_x, next_y = x[-1], y[-1]
+        else:
+            next_x = sum(x[end:next_end]) / (next_end - end)
+            next_y = sum(y[end:next_end]) / (next_end - end)
+        best, best_area = start, -1.0
+        for index in range(start, end):
+            area = abs((x[previous] - next_x) * (y[index] - y[previous]) - (x[previous] - x[index]) * (next_y - y[previous]))
+            if area > best_area:
+                best, best_area = index, area
+        kept.append(rows[best])
+        previous = best
+    kept.append(rows[-1])
+    return kept
+
+
+class TemperatureRequest(NamedTuple):
+    """One lookup for query_temperatures_batch, query_type is 'daily', 'max_span' or 'min_span'."""
+    query_type: str
+    city: str
+    date: datetime
+    date_to: Optional[datetime] = None
+
+
+# Every request is split into parts (a single day, or the day/month/year ranges of split_span).
+# Each part is resolved by a correlated primary-key search and the parts are folded per request.
+BATCH_SQL = """
+    WITH parts(idx, op, source, city, lo, hi) AS (VALUES {values})
+    SELECT p.idx,
+        CASE p.op WHEN 'min' THEN MIN(p.value) ELSE MAX(p.value) END
+    FROM (
+        SELECT parts.idx, parts.op,
+            CASE parts.source
+                WHEN 'day' THEN (SELECT w.temperature_avg FROM WeatherData w
+                                 WHERE w.city_id = c.id AND w.date = parts.lo)
+                WHEN 'days' THEN (SELECT CASE parts.op WHEN 'max' THEN MAX(w.temperature_max) ELSE MIN(w.temperature_min) END
+                                  FROM WeatherData w WHERE w.city_id = c.id AND w.date BETWEEN parts.lo AND parts.hi)
+                WHEN 'months' THEN (SELECT CASE parts.op WHEN 'max' THEN MAX(m.temperature_max) ELSE MIN(m.temperature_min) END
+                                    FROM MonthlyStats m WHERE m.city_id = c.id AND m.month BETWEEN parts.lo AND parts.hi)
+                WHEN 'years' THEN (SELECT CASE parts.op WHEN 'max' THEN MAX(y.temperature_max) ELSE MIN(y.temperature_min) END
+                                   FROM YearlyStats y WHERE y.city_id = c.id AND y.year BETWEEN parts.lo AND parts.hi)
+            END AS value
+        FROM parts
+        JOIN Cities c ON c.city = parts.city
+    ) p
+    GROUP BY p.idx
+    """
+
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER (32766), 6 parameters per part
+BATCH_MAX_PARTS = 5000
+
+
+def batch_parts(index: int, request: TemperatureRequest) -> list[tuple]:
+    if request.query_type == 'daily':
+        assert isinstance(request.date, datetime), "date must be datetime object"
+        day = to_day_number(request.date)
+        return [(index, 'daily', 'day', request.city, day, day)]
+
+    assert request.query_type in ('max_span', 'min_span'), f"unknown query type {request.query_type}"
+    assert isinstance(request.date, datetime) and isinstance(request.date_to, datetime), "dates must be datetime objects"
+    assert request.date <= request.date_to, "date_from needs to be before, or the same day as date_to"
+    op = 'max' if request.query_type == 'max_span' else 'min'
+    days, months, years = split_span(request.date.date(), request.date_to.date())
+    return ([(index, op, 'days', request.city, to_day_number(first), to_day_number(last)) for first, last in days]
+            + [(index, op, 'months', request.city, first, last) for first, last in months]
+            + [(index, op, 'years', request.city, first, last) for first, last in years])
+
+
+def query_temperatures_batch(requests: list[TemperatureRequest], connection: sqlite3.Connection) -> list[Optional[float]]:
+    """Resolve many daily/max/min lookups with one set-based query, results are in input order."""
+    parts = [part for index, request in enumerate(requests) for part in batch_parts(index, request)]
+    results = [None] * len(requests)
+    cursor = connection.cursor()
+    for start in range(0, len(parts), BATCH_MAX_PARTS):
+        chunk = parts[start:start + BATCH_MAX_PARTS]
+        values = ', '.join(['(?, ?, ?, ?, ?, ?)'] * len(chunk))
+        # A request whose parts straddle two chunks is folded here as well
+        for index, value in cursor.execute(BATCH_SQL.format(values=values), [field for part in chunk for field in part]):
+            if value is not None:
+                previous = results[index]
+                if previous is None:
+                    results[index] = value
+                elif requests[index].query_type == 'min_span':
+                    results[index] = min(previous, value)
+                else:
+                    results[index] = max(previous, value)
+    return results
+
+
+class RangeExtremaTree:
+    """Segment tree over one city's daily temperature_max/temperature_min.
+
+    Built once from WeatherData, answers MIN/MAX over any date range in O(log n)
+    without touching the database. Days without data are neutral elements.
+    """
+
+    def __init__(self, rows: list[tuple[int, Optional[float], Optional[float]]]):
+        days = [day for day, _, _ in rows]
+        self.first_day = days[0] if days else 0
+        self.size = size = days[-1] - self.first_day + 1 if days else 0
+        self._max = array('d', [-inf]) * (2 * size)
+        self._min = array('d', [inf]) * (2 * size)
+        for day, (_, temperature_max, temperature_min) in zip(days, rows):
+            if temperature_max is not None:
+                self._max[size + day - self.first_day] = temperature_max
+            if temperature_min is not None:
+                self._min[size + day - self.first_day] = temperature_min
+        for i in range(size - 1, 0, -1):
+            self._max[i] = max(self._max[2 * i], self._max[2 * i + 1])
+            self._min[i] = min(self._min[2 * i], self._min[2 * i + 1])
+
+    def query(self, date_from: date, date_to: date) -> tuple[Optional[float], Optional[float]]:
+        """Return (max temperature_max, min temperature_min) over the inclusive range."""
+        left = max(to_day_number(date_from) - self.first_day, 0) + self.size
+        right = min(to_day_number(date_to) - self.first_day, self.size - 1) + self.size + 1
+        highest, lowest = -inf, inf
+        while left < right:
+            if left & 1:
+                highest, lowest = max(highest, self._max[left]), min(lowest, self._min[left])
+                left += 1
+            if right & 1:
+                right -= 1
+                highest, lowest = max(highest, self._max[right]), min(lowest, self._min[right])
+            left >>= 1
+            right >>= 1
+        return (highest if highest != -inf else None), (lowest if lowest != inf else None)
+
+
+class WeatherQueryService:
+    """Cached front for the temperature queries above.
+
+    City names are resolved to ids in memory, so the statements below hit WeatherData
+    directly without the JOIN. Span queries are answered from a per-city RangeExtremaTree.
+    Results are kept in a bounded LRU cache with a TTL, and everything is dropped
+    whenever another connection commits to the database (e.g. an ingest run).
+    """
+
+    DAILY_SQL = 'SELECT temperature_avg FROM WeatherData WHERE city_id = ? AND date = ?'
+    SERIES_SQL = 'SELECT date, temperature_max, temperature_min FROM WeatherData WHERE city_id = ? ORDER BY date'
+
+    def __init__(
+            self,
+            connection: sqlite3.Connection,
+            max_size: int = 4096,
+            ttl: Optional[float] = 3600,
+            check_interval: float = 1.0,
+            max_trees: int = 64):
+        self.connection = connection
+        self.max_size = max_size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.max_trees = max_trees
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._trees = OrderedDict()
+        self._city_ids = None
+        self._data_version = None
+        self._last_check = float('-inf')
+        # sqlite3 connections must not be used from several threads at once
+        self._lock = threading.RLock()
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._trees.clear()
+            self._city_ids = None
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache), 'trees': len(self._trees)}
+
+    def city_id(self, city: str) -> Optional[int]:
+        with self._lock:
+            if self._city_ids is None:
+                cursor = self.connection.cursor()
+                cursor.execute('SELECT city, id FROM Cities')
+                self._city_ids = dict(cursor.fetchall())
+            return self._city_ids.get(city)
+
+    def temperature_in_city(self, city: str, date: datetime) -> Optional[float]:
+        assert isinstance(date, datetime), "date must be datetime object"
+        day = to_day_number(date)
+        return self._cached(self._key(TemperatureRequest('daily', city, date)), city,
+                            lambda city_id: self._fetch_value(self.DAILY_SQL, city_id, day))
+
+    def max_temperature_in_time_span(self, city: str, date_from: datetime, date_to: datetime) -> Optional[float]:
+        assert isinstance(date_from, datetime) and isinstance(date_to, datetime), "dates must be a datetime objects"
+        assert date_from <= date_to, "date_from needs to be before the date date_to"
+        return self._cached(self._key(TemperatureRequest('max_span', city, date_from, date_to)), city,
+                            lambda city_id: self._tree(city_id).query(date_from.date(), date_to.date())[0])
+
+    def min_temperature_in_time_span(self, city: str, date_from: datetime, date_to: datetime) -> Optional[float]:
+        assert isinstance(date_to, datetime) and isinstance(date_from, datetime), "dates must be datetime objects"
+        assert date_from <= date_to, "date_from needs to be before, or the same day as date_to"
+        return self._cached(self._key(TemperatureRequest('min_span', city, date_from, date_to)), city,
+                            lambda city_id: self._tree(city_id).query(date_from.date(), date_to.date())[1])
+
+    def query_batch(self, requests: list[TemperatureRequest],
+                    load: Optional[Callable[[list[TemperatureRequest]], list[Optional[float]]]] = None) -> list[Optional[float]]:
+        """Like query_temperatures_batch, answering cached requests from memory and the rest in one query.
+
+        load resolves the cache misses instead, e.g. over a ConnectionPool; it runs without holding
+        the service's lock, so it must not use the service's own connection.
+        """
+        results = [None] * len(requests)
+        with self._lock:
+            self._check_data_version()
+            missing = []
+            now = time.monotonic()
+            for index, request in enumerate(requests):
+                entry = self._cache.get(self._key(request))
+                if entry is not None and (self.ttl is None or now - entry[1] < self.ttl):
+                    self._cache.move_to_end(self._key(request))
+                    self.hits += 1
+                    results[index] = entry[0]
+                else:
+                    self.misses += 1
+                    missing.append(index)
+            if missing and load is None:
+                values = query_temperatures_batch([requests[index] for index in missing], self.connection)
+
+        if missing and load is not None:
+            values = load([requests[index] for index in missing])
+
+        if missing:
+            with self._lock:
+                now = time.monotonic()
+                for index, value in zip(missing, values):
+                    results[index] = value
+                    self._cache[self._key(requests[index])] = (value, now)
+                    self._cache.move_to_end(self._key(requests[index]))
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+        return results
+
+    @staticmethod
+    def _key(request: TemperatureRequest) -> tuple:
+        if request.query_type == 'daily':
+            return ('daily', request.city, to_day_number(request.date))
+        return (request.query_type, request.city, request.date.date(), request.date_to.date())
+
+    def _tree(self, city_id: int) -> RangeExtremaTree:
+        tree = self._trees.get(city_id)
+        if tree is None:
+            tree = self._trees[city_id] = RangeExtremaTree(self.connection.execute(self.SERIES_SQL, (city_id,)).fetchall())
+            if len(self._trees) > self.max_trees:
+                self._trees.popitem(last=False)
+        self._trees.move_to_end(city_id)
+        return tree
+
+    def _fetch_value(self, sql: str, *params) -> Optional[float]:
+        row = self.connection.execute(sql, params).fetchone()
+        if row and row[0] is not None:
+            return row[0]
+        return None
+
+    def _check_data_version(self) -> None:
+        # data_version changes whenever another connection commits, checked at most every check_interval seconds
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        data_version = self.connection.execute('PRAGMA data_version').fetchone()[0]
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self.invalidate()
+
+    def _cached(self, key: tuple, city: str, load: Callable[[int], Optional[float]]) -> Optional[float]:
+        with self._lock:
+            self._check_data_version()
+            entry = self._cache.get(key)
+            if entry is not None and (self.ttl is None or time.monotonic() - entry[1] < self.ttl):
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+            city_id = self.city_id(city)
+            value = load(city_id) if city_id is not None else None
+
+            self._cache[key] = (value, time.monotonic())
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+            return value
@@ -0,0 +1,63 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional
+from db_utils import ConnectionPool
+from query_database import TemperatureRequest, WeatherQueryService, query_temperatures_batch
+
+logger = logging.getLogger(__name__)
+
+
+def build_query_plan(daily_queries: list[tuple[str, datetime]],
+                     max_time_span_param: Optional[tuple[str, datetime, datetime]],
+                     min_time_span_param: Optional[tuple[str, datetime, datetime]]) -> list[TemperatureRequest]:
+    """Every intent of one parsed question as a list of lookups: daily queries first, then max and min spans."""
+    plan = [TemperatureRequest('daily', city, date_object) for city, date_object in daily_queries or []]
+    if max_time_span_param is not None:
+        plan.append(TemperatureRequest('max_span', *max_time_span_param))
+    if min_time_span_param is not None:
+        plan.append(TemperatureRequest('min_span', *min_time_span_param))
+    return plan
+
+
+def plan_tasks(plan: list[TemperatureRequest]) -> list[list[int]]:
+    """Group a plan into independent tasks: all daily lookups share one batch query, each span gets its own."""
+    daily = [index for index, request in enumerate(plan) if request.query_type == 'daily']
+    spans = [[index] for index, request in enumerate(plan) if request.query_type != 'daily']
+    return ([daily] if daily else []) + spans
+
+
+class QueryPlanExecutor:
+    """Runs the tasks of a query plan in parallel, each on its own pooled read-only connection."""
+
+    def __init__(self, pool: ConnectionPool, max_workers: Optional[int] = None):
+        self.pool = pool
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or pool.size, thread_name_prefix='plan')
+
+    def run(self, plan: list[TemperatureRequest], service: Optional[WeatherQueryService] = None) -> list[Optional[float]]:
+        """Values of all lookups in plan order, answered from the service's cache first when one is given."""
+        if service is not None:
+            return service.query_batch(plan, load=self._run_parallel)
+        return self._run_parallel(plan)
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def _run_task(self, requests: list[TemperatureRequest]) -> list[Optional[float]]:
+        with self.pool.connection() as connection:
+            return query_temperatures_batch(requests, connection)
+
+    def _run_parallel(self, plan: list[TemperatureRequest]) -> list[Optional[float]]:
+        """A failing task (e.g. a reversed span from the LLM) only leaves its own lookups as None."""
+        tasks = plan_tasks(plan)
+        results = [None] * len(plan)
+        futures = [(task, self._executor.submit(self._run_task, [plan[index] for index in task])) for task in tasks]
+        for task, future in futures:
+            try:
+                values = future.result()
+            except Exception as e:
+                logger.warning("Error while fetching %s: %s", [plan[index] for index in task], e)
+                continue
+            for index, value in zip(task, values):
+                results[index] = value
+        return results
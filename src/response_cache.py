@@ -0,0 +1,138 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from query_database import TemperatureRequest
+
+RESPONSE_PREFIX = '---Response to the actual user---'
+
+
+class ResponseCache:
+    """LRU/TTL cache of final answers, keyed on the parsed queries and the values the database returned.
+
+    With a path the answers are also written to a small SQLite file, so they survive restarts. The file
+    is only read when the cache is created and written by a background thread, so get() and put()
+    never wait for disk I/O and are safe to call from an event loop. Only answers of is_cacheable()
+    plans belong here, the key does not record what a comparison asks for.
+    """
+
+    def __init__(self, max_size: int = 10_000, ttl: Optional[float] = 24 * 3600, path: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._store = None
+        self._writes = queue.Queue()
+        self._writer = None
+        if path is not None:
+            self._store = sqlite3.connect(path, check_same_thread=False)
+            with self._store:
+                self._store.execute("""
+                    CREATE TABLE IF NOT EXISTS ResponseCache (
+                        key TEXT PRIMARY KEY,
+                        response TEXT NOT NULL,
+                        created_at REAL NOT NULL
+                    )""")
+                if ttl is not None:
+                    self._store.execute('DELETE FROM ResponseCache WHERE created_at < ?', (time.time() - ttl,))
+            # The newest answers that fit, oldest first so the LRU order matches their age
+            rows = self._store.execute('SELECT key, response, created_at FROM ResponseCache ORDER BY created_at DESC LIMIT ?',
+                                       (max_size,)).fetchall()
+            for key, response, created_at in reversed(rows):
+                self._cache[key] = (response, created_at)
+            self._writer = threading.Thread(target=self._write_behind, name='response-cache-writer', daemon=True)
+            self._writer.start()
+
+    @staticmethod
+    def key(requests: list[TemperatureRequest], db_responses: list[str]) -> str:
+        queries = [(request.query_type, ' '.join(request.city.split()).lower(), request.date.strftime('%Y-%m-%d'),
+                    request.date_to.strftime('%Y-%m-%d') if request.date_to is not None else None)
+                   for request in requests]
+        return json.dumps([queries, db_responses], ensure_ascii=False)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and (self.ttl is None or time.time() - entry[1] < self.ttl):
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, response: str) -> None:
+        entry = (response, time.time())
+        with self._lock:
+            self._remember(key, entry)
+        if self._writer is not None:
+            self._writes.put((key, *entry))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache)}
+
+    def close(self) -> None:
+        """Write the pending answers and close the file."""
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def _write_behind(self) -> None:
+        while True:
+            rows = [self._writes.get()]
+            # Everything queued meanwhile goes into the same transaction
+            while not self._writes.empty():
+                rows.append(self._writes.get())
+            stop = None in rows
+            rows = [row for row in rows if row is not None]
+            if rows:
+                with self._store:
+                    self._store.executemany('INSERT OR REPLACE INTO ResponseCache (key, response, created_at) VALUES (?, ?, ?)', rows)
+            if stop:
+                return
+
+    def _remember(self, key: str, entry: tuple) -> None:
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+
+def _is_number(value: str) -> bool:
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def is_cacheable(requests: list[TemperatureRequest]) -> bool:
+    """Whether the answer follows from the lookups and their values alone.
+
+    Several daily lookups are a comparison ("Which was colder, Paris or Belgrade on ..."), whose
+    answer depends on the direction the question asks for, so those are always phrased by the LLM.
+    """
+    return sum(request.query_type == 'daily' for request in requests) <= 1
+
+
+def render_response(requests: list[TemperatureRequest], db_responses: list[str]) -> Optional[str]:
+    """Phrase the standard daily and span answers without the LLM, None for anything else."""
+    if len(requests) != 1 or len(db_responses) != 1:
+        return None
+    request, value = requests[0], db_responses[0]
+    if not _is_number(value):
+        return f"{RESPONSE_PREFIX} {value}."
+    if request.query_type == 'daily':
+        return f"{RESPONSE_PREFIX} The temperature in {request.city} on {request.date.strftime('%d-%m-%Y')} was {value}°C."
+    extreme = 'maximum' if request.query_type == 'max_span' else 'minimum'
+    return (f"{RESPONSE_PREFIX} The {extreme} temperature in {request.city} from {request.date.strftime('%d-%m-%Y')} "
+            f"to {request.date_to.strftime('%d-%m-%Y')} was {value}°C.")
@@ -0,0 +1,111 @@
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+
+# Local stand-in for the OpenAI-compatible chat completions API, for testing and benchmarking
+# the bot without network access or API spend. Point the bot at it with
+#   BASE_URL=http://127.0.0.1:8001 API_KEY=stub python flask_app.py weather.db
+
+
+def fake_completion(messages: list[dict]) -> str:
+    """Answer like the real model would: tags for a user question, a sentence for <VALUE> messages."""
+    values = []
+    for message in reversed(messages):
+        if not message['content'].startswith('<VALUE>'):
+            break
+        values.insert(0, message['content'][len('<VALUE>'):])
+    if values:
+        return f"---Response to the actual user--- The temperature was {', '.join(values)}°C."
+
+    user_query = messages[-1]['content']
+    city = re.search(r"\bin ([A-Z][\w ]*?)(?= on | from |\?|$)", user_query)
+    city = city.group(1) if city else 'Belgrade'
+    dates = re.findall(r"\d{2}-\d{2}-\d{4}", user_query) or ['01-10-2020']
+    if len(dates) >= 2:
+        tag = 'MIN_TEMP' if re.search(r"\bmin", user_query, re.IGNORECASE) else 'MAX_TEMP'
+        return f"<{tag}><{city}><{dates[0]}><{dates[1]}>"
+    return f"<TEMP><{city}><{dates[0]}>"
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+    token_delay = 0.0
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if not self.path.endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.delay)
+        content = fake_completion(body['messages'])
+        usage = {'prompt_tokens': sum(len(message['content'].split()) for message in body['messages']),
+                 'completion_tokens': len(content.split())}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        if body.get('stream'):
+            self.stream_completion(body, content, usage)
+            return
+        payload = json.dumps({
+            'id': 'chatcmpl-stub',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'stub'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': usage,
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def stream_completion(self, body: dict, content: str, usage: dict) -> None:
+        """Send the completion word by word as server-sent events, like the real API with stream=True."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        pieces = [{'role': 'assistant', 'content': ''}] + [{'content': word} for word in re.findall(r"\S+\s*", content)]
+        for index, delta in enumerate(pieces):
+            if index > 1:
+                time.sleep(self.token_delay)
+            chunk = {
+                'id': 'chatcmpl-stub',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body.get('model', 'stub'),
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}],
+            }
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        if (body.get('stream_options') or {}).get('include_usage'):
+            # Like the real API, the usage arrives in a last chunk without choices
+            chunk = {'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                     'model': body.get('model', 'stub'), 'choices': [], 'usage': usage}
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, text: str) -> None:
+        data = text.encode()
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI-compatible chat completions API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds to wait before every completion, to mimic model latency")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Seconds between streamed words, to mimic generation speed")
+    args = parser.parse_args()
+
+    StubLLMHandler.delay = args.delay
+    StubLLMHandler.token_delay = args.token_delay
+    server = ThreadingHTTPServer((args.host, args.port), StubLLMHandler)
+    print(f"Stub LLM listening on http://{args.host}:{args.port}")
+    server.serve_forever()
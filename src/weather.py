@@ -0,0 +1,100 @@
+import argparse
+import os
+import runpy
+import sqlite3
+import sys
+from datetime import datetime
+from pathlib import Path
+
+# One entry point for the scripts of this directory, e.g.
+#   python weather.py build weather.csv weather.db
+#   python weather.py query weather.db Belgrade 2020-10-01
+#   python weather.py query weather.db Paris 2022-02-10 2022-02-15 --min
+#   python weather.py analyze weather.csv --list-cities
+#   python weather.py serve weather.db --port 8000 [--async]
+# Only the modules the chosen command needs are imported: a `query` loads neither pandas nor openai nor Flask.
+
+# Commands handled by an existing script, which parses the remaining arguments itself
+SCRIPTS = {
+    'build': ('build_database', "Load a CSV into a database"),
+    'migrate': ('migrate_database', "Upgrade a database to the current schema"),
+    'analyze': ('analyze_data', "Statistics and plots of a CSV"),
+    'serve': ('flask_app', "Serve the chat bot and the JSON API, --async serves async_app.py instead"),
+    'chat': ('chat_bot', "Ask one question on the command line"),
+}
+DATE_FORMATS = ('%Y-%m-%d', '%d-%m-%Y')
+
+
+def run_script(module: str, argv: list[str]) -> None:
+    """Run module as if started with `python <module>.py <argv>`."""
+    sys.argv = [os.path.join(os.path.dirname(os.path.abspath(__file__)), f'{module}.py'), *argv]
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+def parse_date(value: str) -> datetime:
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"'{value}' is not a date in YYYY-MM-DD or DD-MM-YYYY format")
+
+
+def query(args: argparse.Namespace) -> int:
+    """Print the temperature of a day, or the max (--min: min) of a span, straight from the database."""
+    from query_database import (query_temperature_in_city, query_max_temperature_in_time_span_per_city,
+                                query_min_temperature_in_time_span_per_city)
+
+    if not os.path.exists(args.filename):
+        raise SystemExit(f"{args.filename} does not exist")
+    connection = sqlite3.connect(Path(args.filename).absolute().as_uri() + '?mode=ro', uri=True)
+    try:
+        if args.date_to is None:
+            value = query_temperature_in_city(args.city, args.date, connection)
+            period = f"on {args.date:%Y-%m-%d}"
+        else:
+            if args.date_to < args.date:
+                raise SystemExit("the end of the span must not be before its start")
+            func = query_min_temperature_in_time_span_per_city if args.min else query_max_temperature_in_time_span_per_city
+            value = func(args.city, args.date, args.date_to, connection)
+            period = f"from {args.date:%Y-%m-%d} to {args.date_to:%Y-%m-%d}"
+    finally:
+        connection.close()
+    if value is None:
+        print(f"No data available for {args.city} {period}")
+        return 1
+    print(value)
+    return 0
+
+
+def main(argv: list[str] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in SCRIPTS:
+        command, rest = argv[0], argv[1:]
+        module = SCRIPTS[command][0]
+        if command == 'serve' and '--async' in rest:
+            module = 'async_app'
+            rest = [arg for arg in rest if arg != '--async']
+        run_script(module, rest)
+        return 0
+
+    parser = argparse.ArgumentParser(description="Weather database tools and chat bot")
+    commands = parser.add_subparsers(dest='command', required=True, metavar='command')
+    for command, (module, help) in SCRIPTS.items():
+        # Listed for --help only, the arguments are parsed by the script (see `weather.py <command> --help`)
+        commands.add_parser(command, help=help, add_help=False)
+
+    query_parser = commands.add_parser('query', help="Look up a temperature without the LLM")
+    query_parser.add_argument("filename", help="The name of the SQLite database file")
+    query_parser.add_argument("city")
+    query_parser.add_argument("date", type=parse_date, help="Day of the average temperature, or the first day of a span")
+    query_parser.add_argument("date_to", type=parse_date, nargs='?', help="Last day of a span, prints its maximum temperature")
+    query_parser.add_argument("--min", action="store_true", help="Print the minimum temperature of the span instead")
+    query_parser.set_defaults(func=query)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
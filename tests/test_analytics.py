@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+from analytics import compute_statistics
+
+CITIES = ['Zagreb', 'Belgrade', 'Paris']
+
+
+def weather(categories: list[str]) -> pd.DataFrame:
+    """Three cities whose temperatures are far apart, so a mixed-up city shows in every statistic."""
+    rng = np.random.default_rng(0)
+    dates = pd.date_range('2020-01-01', '2021-12-31', freq='D')
+    frames = []
+    for offset, city in zip((0, 20, 40), CITIES):
+        tavg = offset + 10 * np.sin(np.arange(len(dates)) / 58) + rng.normal(0, 2, len(dates))
+        tavg[len(dates) // 2] += 25     # one extreme day per city
+        frames.append(pd.DataFrame({'city': city, 'date': dates, 'tavg': tavg, 'tmin': tavg - 5, 'tmax': tavg + 5}))
+    df = pd.concat(frames).sample(frac=1, random_state=1)
+    df['city'] = pd.Categorical(df['city'], categories=categories)
+    return df
+
+
+def test_statistics_do_not_depend_on_category_order():
+    alphabetical = compute_statistics(weather(sorted(CITIES)))
+    for categories in (CITIES, sorted(CITIES, reverse=True)):
+        for expected, actual in zip(alphabetical, compute_statistics(weather(categories))):
+            pd.testing.assert_frame_equal(expected, actual, check_categorical=False)
+
+
+def test_rolling_mean_stays_with_its_city():
+    df = weather(CITIES)
+    summary, _, extremes = compute_statistics(df, window=30)
+    assert list(summary.index) == sorted(CITIES)
+    for city, city_df in df.groupby('city', observed=True):
+        rolling = city_df.sort_values('date').set_index('date')['tavg'].rolling('30D', min_periods=1).mean()
+        city_extremes = extremes[extremes['city'] == city]
+        assert len(city_extremes) >= 1
+        np.testing.assert_allclose(city_extremes['rolling_tavg'].to_numpy(), rolling[city_extremes['date']].to_numpy())
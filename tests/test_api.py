@@ -0,0 +1,70 @@
+import contextlib
+import io
+import sqlite3
+from datetime import datetime
+import pytest
+from flask import Flask
+from api import api
+from build_database import build_bulk
+from data_utils import load_data_chunks
+from db_utils import ConnectionPool
+from generate_data import generate_csv
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('api')
+    csv_file, db_file = str(directory / 'weather.csv'), str(directory / 'weather.db')
+    generate_csv(csv_file, 2, datetime(2020, 1, 1), datetime(2020, 12, 31), seed=1)
+    connection = sqlite3.connect(db_file)
+    with contextlib.redirect_stdout(io.StringIO()):
+        build_bulk(load_data_chunks(csv_file, float_dtype='float64'), connection)
+    connection.close()
+
+    app = Flask(__name__)
+    app.extensions['db_pool'] = ConnectionPool(db_file, size=2)
+    app.register_blueprint(api)
+    yield app.test_client()
+    app.extensions['db_pool'].close()
+
+
+@pytest.mark.parametrize('body', [
+    [1, 2],
+    'requests',
+    None,
+    {'requests': {'type': 'temp'}},
+    {'requests': [1]},
+    {'requests': [{'type': ['temp'], 'city': 'Belgrade', 'date': '2020-10-01'}]},
+    {'requests': [{'type': {'temp': 1}, 'city': 'Belgrade', 'date': '2020-10-01'}]},
+    {'requests': [{'type': 'avg', 'city': 'Belgrade', 'date': '2020-10-01'}]},
+    {'requests': [{'type': 'temp', 'city': ['Belgrade'], 'date': '2020-10-01'}]},
+    {'requests': [{'type': 'temp', 'city': 'Belgrade', 'date': 20201001}]},
+    {'requests': [{'type': 'max', 'city': 'Belgrade', 'from': '2020-10-05', 'to': '2020-10-01'}]},
+])
+def test_batch_rejects_malformed_bodies(client, body):
+    response = client.post('/api/batch', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_batch_rejects_invalid_json(client):
+    response = client.post('/api/batch', data='{"requests": [', content_type='application/json')
+    assert response.status_code == 400
+
+
+def test_batch_answers_lookups(client):
+    response = client.post('/api/batch', json={'requests': [
+        {'type': 'temp', 'city': 'Belgrade', 'date': '2020-10-01'},
+        {'type': 'max', 'city': 'Belgrade', 'from': '2020-10-01', 'to': '2020-10-31'},
+        {'type': 'min', 'city': 'Atlantis', 'from': '2020-10-01', 'to': '2020-10-31'}]})
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert isinstance(results[0]['temperature'], float) and isinstance(results[1]['temperature'], float)
+    assert results[2]['temperature'] is None
+
+
+@pytest.mark.parametrize('query', ['points=²', 'points=٣', 'points=0', 'points=-5', 'points=1.5', 'max_points=²', 'points=2'])
+def test_series_rejects_invalid_point_counts(client, query):
+    response = client.get(f'/api/series?city=Belgrade&from=2020-01-01&to=2020-12-31&{query}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
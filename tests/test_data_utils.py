@@ -0,0 +1,22 @@
+from datetime import datetime
+import pandas as pd
+import pytest
+import data_utils
+from generate_data import generate_csv
+
+pytest.importorskip('pyarrow')
+
+
+def test_use_cache_false_reads_the_csv(tmp_path, monkeypatch):
+    csv_file = str(tmp_path / 'weather.csv')
+    generate_csv(csv_file, 2, datetime(2020, 1, 1), datetime(2020, 3, 31), seed=1)
+    data_utils.ensure_cache(csv_file)
+    assert data_utils.cache_is_fresh(csv_file)
+    cached = pd.concat(data_utils.load_data_chunks(csv_file, float_dtype='float64'), ignore_index=True)
+
+    def no_cache(path):
+        raise AssertionError("the cache was read")
+    monkeypatch.setattr(data_utils, 'open_cache', no_cache)
+    streamed = pd.concat(data_utils.load_data_chunks(csv_file, 100, float_dtype='float64', use_cache=False), ignore_index=True)
+    pd.testing.assert_frame_equal(streamed.astype({'city': str, 'country': str}), cached.astype({'city': str, 'country': str}),
+                                  check_dtype=False)
@@ -0,0 +1,140 @@
+import contextlib
+import io
+import sqlite3
+from datetime import datetime
+import pandas as pd
+import pytest
+import migrate_database
+from build_database import build_bulk
+from data_utils import load_data_chunks
+from db_utils import SCHEMA_VERSION, schema_version
+from generate_data import generate_csv
+from query_database import (query_temperature_in_city, query_max_temperature_in_time_span_per_city,
+                            query_min_temperature_in_time_span_per_city, query_temperature_series)
+
+CITIES = ['Belgrade', 'Zagreb', 'Paris']
+
+
+def build_v1(df: pd.DataFrame, connection: sqlite3.Connection) -> None:
+    """The schema and inserts of the original build_database.py, which appended to an existing file."""
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA foreign_keys = ON;')
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS Cities (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        city TEXT NOT NULL,
+        country TEXT NOT NULL,
+        lat FLOAT,
+        lon FLOAT
+    )""")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS WeatherData (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        city_id INTEGER,
+        date DATE,
+        temperature_avg FLOAT,
+        temperature_min FLOAT,
+        temperature_max FLOAT,
+        wind_direction FLOAT,
+        wind_speed FLOAT,
+        pressure FLOAT,
+        FOREIGN KEY(city_id) REFERENCES Cities(id)
+    )""")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_city_id ON WeatherData(city_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_city_name ON Cities(city);')
+    for index, row in df[['city', 'country', 'Latitude', 'Longitude']].drop_duplicates().iterrows():
+        cursor.execute('INSERT OR IGNORE INTO Cities (city, country, lat, lon) VALUES (?, ?, ?, ?)',
+                       (row['city'], row['country'], row['Latitude'], row['Longitude']))
+    for index, row in df.iterrows():
+        cursor.execute('SELECT id FROM Cities WHERE city = ?', (row['city'],))
+        city_id = cursor.fetchone()[0]
+        cursor.execute("""
+        INSERT INTO WeatherData (city_id, date, temperature_avg, temperature_min, temperature_max, wind_direction, wind_speed, pressure)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        (city_id, row['date'].strftime('%Y-%m-%d'), row['tavg'], row['tmin'], row['tmax'], row['wdir'], row['wspd'], row['pres']))
+    connection.commit()
+
+
+def read_csv_v1(filepath: str) -> pd.DataFrame:
+    """The original load_data: missing values as 0, dates parsed from DD-MM-YYYY."""
+    df = pd.read_csv(filepath).fillna(0)
+    df['date'] = pd.to_datetime(df['date'], format='%d-%m-%Y')
+    return df
+
+
+@pytest.fixture
+def databases(tmp_path):
+    """A v1 file built twice, the second time with changed temperatures, and a v2 file built from the second CSV."""
+    first_csv, second_csv = str(tmp_path / 'first.csv'), str(tmp_path / 'second.csv')
+    generate_csv(first_csv, len(CITIES), datetime(2001, 11, 20), datetime(2003, 2, 10), seed=1)
+    df = pd.read_csv(first_csv)
+    changed = df.index % 7 == 0
+    for column in ('tavg', 'tmin', 'tmax'):
+        df.loc[changed, column] += 3.5
+    df.to_csv(second_csv, index=False)
+
+    v1 = sqlite3.connect(str(tmp_path / 'v1.db'))
+    build_v1(read_csv_v1(first_csv), v1)
+    build_v1(read_csv_v1(second_csv), v1)
+    # The v1 schema allowed rows without a date or city, they cannot be keyed in v2
+    v1.execute("INSERT INTO WeatherData (city_id, date, temperature_avg) VALUES (1, NULL, 99), (NULL, '2002-01-01', 99)")
+    v1.commit()
+
+    v2 = sqlite3.connect(str(tmp_path / 'v2.db'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        build_bulk(load_data_chunks(second_csv, float_dtype='float64'), v2)
+    yield v1, v2
+    v1.close()
+    v2.close()
+
+
+def table(connection: sqlite3.Connection, sql: str) -> list[tuple]:
+    return sorted(connection.execute(sql).fetchall())
+
+
+def test_migrated_database_answers_like_a_fresh_build(databases):
+    v1, v2 = databases
+    assert v1.execute('SELECT COUNT(*) FROM Cities').fetchone()[0] == 2 * len(CITIES)
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        migrate_database.migrate(v1)
+    assert 'Skipping 2 rows' in output.getvalue()
+    assert schema_version(v1) == SCHEMA_VERSION
+
+    for sql in ('SELECT c.city, w.date, w.temperature_avg, w.temperature_min, w.temperature_max FROM WeatherData w JOIN Cities c ON c.id = w.city_id',
+                'SELECT c.city, m.month, m.temperature_min, m.temperature_max, m.days FROM MonthlyStats m JOIN Cities c ON c.id = m.city_id',
+                'SELECT c.city, y.year, y.temperature_min, y.temperature_max, y.days FROM YearlyStats y JOIN Cities c ON c.id = y.city_id'):
+        assert table(v1, sql) == table(v2, sql)
+    assert table(v1, 'SELECT city FROM Cities') == [(city,) for city in sorted(CITIES)]
+
+    days = [datetime(2001, 11, 20), datetime(2002, 1, 1), datetime(2002, 6, 30), datetime(2003, 2, 10), datetime(2004, 1, 1)]
+    spans = [(datetime(2001, 1, 1), datetime(2003, 12, 31)), (datetime(2002, 1, 1), datetime(2002, 12, 31)),
+             (datetime(2002, 3, 15), datetime(2002, 4, 2)), (datetime(2002, 5, 5), datetime(2002, 5, 5))]
+    for city in CITIES + ['Atlantis']:
+        for day in days:
+            assert query_temperature_in_city(city, day, v1) == query_temperature_in_city(city, day, v2)
+        for date_from, date_to in spans:
+            for func in (query_max_temperature_in_time_span_per_city, query_min_temperature_in_time_span_per_city):
+                assert func(city, date_from, date_to, v1) == func(city, date_from, date_to, v2)
+            assert (query_temperature_series(city, date_from, date_to, v1, 'monthly')
+                    == query_temperature_series(city, date_from, date_to, v2, 'monthly'))
+
+
+def test_failed_migration_leaves_v1_untouched(databases, monkeypatch):
+    v1, _ = databases
+    tables = table(v1, "SELECT type, name FROM sqlite_master")
+    rows = table(v1, 'SELECT * FROM WeatherData')
+
+    def interrupt(cursor):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(migrate_database, 'refresh_rollups', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        migrate_database.migrate(v1)
+
+    assert schema_version(v1) == 1
+    assert table(v1, "SELECT type, name FROM sqlite_master") == tables
+    assert table(v1, 'SELECT * FROM WeatherData') == rows
+
+    monkeypatch.undo()
+    with contextlib.redirect_stdout(io.StringIO()):
+        migrate_database.migrate(v1)
+    assert schema_version(v1) == SCHEMA_VERSION
@@ -0,0 +1,174 @@
+import contextlib
+import io
+import random
+import sqlite3
+from datetime import date, datetime, timedelta
+import pandas as pd
+import pytest
+import query_database
+from build_database import build_bulk
+from data_utils import load_data_chunks
+from db_utils import to_day_number
+from generate_data import generate_csv
+from query_database import (TemperatureRequest, WeatherQueryService, split_span, lttb, series_buckets,
+                            query_max_temperature_in_time_span_per_city, query_min_temperature_in_time_span_per_city,
+                            query_temperatures_batch, query_temperature_series)
+
+# Data starts and ends mid-month, so the rollups of the first and last month are partial
+DATA_FROM = datetime(2000, 1, 15)
+DATA_TO = datetime(2004, 11, 20)
+CITIES = ['Belgrade', 'Zagreb', 'Paris']
+UNKNOWN_CITY = 'Atlantis'
+
+
+@pytest.fixture(scope='module')
+def connection(tmp_path_factory):
+    """Database built the way build_database.py does it, from a generated CSV with random days missing."""
+    directory = tmp_path_factory.mktemp('weather')
+    csv_file, db_file = str(directory / 'weather.csv'), str(directory / 'weather.db')
+    generate_csv(csv_file, len(CITIES), DATA_FROM, DATA_TO, seed=1)
+    df = pd.read_csv(csv_file)
+    rng = random.Random(1)
+    # Gaps: single days in Zagreb and Paris and all of Paris' 2002, Belgrade stays complete
+    keep = [city == 'Belgrade' or (rng.random() > 0.05 and not (city == 'Paris' and day.endswith('2002')))
+            for city, day in zip(df['city'], df['date'])]
+    df[keep].to_csv(csv_file, index=False)
+
+    connection = sqlite3.connect(db_file, check_same_thread=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        build_bulk(load_data_chunks(csv_file, float_dtype='float64'), connection)
+    yield connection
+    connection.close()
+
+
+def brute_force(connection: sqlite3.Connection, request: TemperatureRequest):
+    if request.query_type == 'daily':
+        sql = 'SELECT temperature_avg FROM WeatherData w JOIN Cities c ON c.id = w.city_id WHERE c.city = ? AND w.date BETWEEN ? AND ?'
+        date_to = request.date
+    else:
+        aggregate, column = ('MAX', 'temperature_max') if request.query_type == 'max_span' else ('MIN', 'temperature_min')
+        sql = f'SELECT {aggregate}(w.{column}) FROM WeatherData w JOIN Cities c ON c.id = w.city_id WHERE c.city = ? AND w.date BETWEEN ? AND ?'
+        date_to = request.date_to
+    row = connection.execute(sql, (request.city, to_day_number(request.date), to_day_number(date_to))).fetchone()
+    return row[0] if row else None
+
+
+def edge_spans() -> list[tuple[datetime, datetime]]:
+    """Spans starting or ending on month and year boundaries, single days, and ranges partly or fully outside the data."""
+    spans = [
+        (datetime(2001, 1, 1), datetime(2001, 12, 31)),
+        (datetime(2001, 1, 1), datetime(2003, 12, 31)),
+        (datetime(2000, 12, 31), datetime(2002, 1, 1)),
+        (datetime(2001, 3, 1), datetime(2001, 3, 31)),
+        (datetime(2001, 2, 28), datetime(2001, 3, 1)),
+        (datetime(2004, 2, 1), datetime(2004, 2, 29)),
+        (datetime(2001, 3, 1), datetime(2002, 2, 28)),
+        (datetime(2000, 1, 1), datetime(2000, 1, 31)),
+        (datetime(2000, 1, 15), datetime(2004, 11, 20)),
+        (datetime(1999, 1, 1), datetime(2006, 12, 31)),
+        (datetime(1990, 1, 1), datetime(1999, 12, 31)),
+        (datetime(2005, 1, 1), datetime(2005, 1, 1)),
+        (datetime(2002, 1, 1), datetime(2002, 12, 31)),
+        (datetime(2001, 12, 1), datetime(2003, 1, 31)),
+    ]
+    spans += [(day, day) for day in (datetime(2000, 1, 15), datetime(2001, 1, 1), datetime(2001, 12, 31), datetime(2004, 11, 20))]
+    return spans
+
+
+def random_spans(count: int, seed: int) -> list[tuple[datetime, datetime]]:
+    rng = random.Random(seed)
+    spans = []
+    for _ in range(count):
+        first = DATA_FROM + timedelta(days=rng.randrange(-400, (DATA_TO - DATA_FROM).days + 400))
+        spans.append((first, first + timedelta(days=rng.choice([0, rng.randrange(40), rng.randrange(400), rng.randrange(2000)]))))
+    return spans
+
+
+def span_requests(spans: list[tuple[datetime, datetime]], seed: int) -> list[TemperatureRequest]:
+    rng = random.Random(seed)
+    return [TemperatureRequest(rng.choice(['max_span', 'min_span']), rng.choice(CITIES + [UNKNOWN_CITY]), first, last)
+            for first, last in spans]
+
+
+def month_end(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1) - timedelta(days=1)
+
+
+def test_split_span_covers_every_day_once():
+    rng = random.Random(0)
+    cases = [(date(2001, 1, 1), date(2001, 12, 31)), (date(2000, 12, 31), date(2001, 1, 1)), (date(2001, 2, 1), date(2001, 2, 28)),
+             (date(2004, 2, 29), date(2004, 2, 29)), (date(2000, 1, 2), date(2000, 12, 30)), (date(1999, 12, 1), date(2001, 1, 31))]
+    cases += [(first, first + timedelta(days=rng.choice([rng.randrange(70), rng.randrange(3000)])))
+              for first in (date(1990, 1, 1) + timedelta(days=rng.randrange(15000)) for _ in range(20000))]
+    for date_from, date_to in cases:
+        days, months, years = split_span(date_from, date_to)
+        intervals = list(days)
+        intervals += [(date.fromisoformat(first + '-01'), month_end(date.fromisoformat(last + '-01'))) for first, last in months]
+        intervals += [(date(first, 1, 1), date(last, 12, 31)) for first, last in years]
+        intervals.sort()
+        # Sorted parts that each follow the previous one without a gap or overlap cover every day exactly once
+        assert all(first <= last for first, last in intervals), (date_from, date_to)
+        assert intervals[0][0] == date_from and intervals[-1][1] == date_to, (date_from, date_to)
+        assert all(last + timedelta(days=1) == following for (_, last), (following, _) in zip(intervals, intervals[1:])), (date_from, date_to)
+
+
+def test_span_queries_match_brute_force(connection):
+    requests = span_requests(edge_spans() * 2 + random_spans(3000, seed=2), seed=3)
+    for request in requests:
+        func = (query_max_temperature_in_time_span_per_city if request.query_type == 'max_span'
+                else query_min_temperature_in_time_span_per_city)
+        assert func(request.city, request.date, request.date_to, connection) == brute_force(connection, request), request
+
+
+def test_range_extrema_tree_matches_brute_force(connection):
+    service = WeatherQueryService(connection)
+    for request in span_requests(edge_spans() * 2 + random_spans(3000, seed=4), seed=5):
+        func = service.max_temperature_in_time_span if request.query_type == 'max_span' else service.min_temperature_in_time_span
+        assert func(request.city, request.date, request.date_to) == brute_force(connection, request), request
+
+
+@pytest.mark.parametrize('max_parts', [query_database.BATCH_MAX_PARTS, 7])
+def test_batch_matches_brute_force(connection, monkeypatch, max_parts):
+    # A small chunk size makes requests straddle chunks, their parts are then folded in Python
+    monkeypatch.setattr(query_database, 'BATCH_MAX_PARTS', max_parts)
+    rng = random.Random(6)
+    requests = span_requests(edge_spans() + random_spans(500, seed=7), seed=8)
+    requests += [TemperatureRequest('daily', rng.choice(CITIES + [UNKNOWN_CITY]), first) for first, _ in random_spans(300, seed=9)]
+    rng.shuffle(requests)
+    assert query_temperatures_batch(requests, connection) == [brute_force(connection, request) for request in requests]
+
+
+def test_series_buckets_count_rows(connection):
+    for first, last in random_spans(300, seed=11):
+        first, last = max(first, DATA_FROM), min(last, DATA_TO)
+        if first > last:
+            continue
+        for resolution in ('weekly', 'monthly'):
+            rows = query_temperature_series('Belgrade', first, last, connection, resolution)
+            # Belgrade has every day, so every week and month of the range has a row
+            assert len(rows) == series_buckets(first, last, resolution), (first, last, resolution)
+
+
+def test_lttb_keeps_one_row_per_bucket(connection):
+    rows = query_temperature_series('Zagreb', DATA_FROM, DATA_TO, connection)
+    for points in (3, 4, 10, 97, 500, len(rows) - 1):
+        kept = lttb(rows, points)
+        assert len(kept) == points
+        assert kept[0] == rows[0] and kept[-1] == rows[-1]
+        assert [row[0] for row in kept] == sorted({row[0] for row in kept})
+        assert set(kept) <= set(rows)
+        # Row i of the result comes from bucket i - 1 of the rows in between the endpoints
+        bucket_size = (len(rows) - 2) / (points - 2)
+        for bucket, row in enumerate(kept[1:-1]):
+            index = rows.index(row)
+            assert int(bucket * bucket_size) + 1 <= index < int((bucket + 1) * bucket_size) + 1
+    assert lttb(rows, len(rows)) == rows
+    assert lttb(rows[:2], 5) == rows[:2]
+
+
+def test_lttb_keeps_spikes():
+    rows = [(date(2001, 1, 1) + timedelta(days=day), 10.0, 5.0, 15.0) for day in range(1000)]
+    rows[123] = (rows[123][0], 45.0, 40.0, 50.0)
+    rows[789] = (rows[789][0], -30.0, -35.0, -25.0)
+    kept = lttb(rows, 20)
+    assert rows[123] in kept and rows[789] in kept
@@ -0,0 +1,37 @@
+from datetime import datetime
+from chat_bot import cached_response
+from intent_parser import IntentParser
+from response_cache import ResponseCache, render_response
+from query_plan import build_query_plan
+
+CITIES = ['Belgrade', 'Paris', 'New York']
+
+
+def plan(question: str):
+    return build_query_plan(*IntentParser(CITIES).parse(question))
+
+
+def test_comparison_words_need_several_cities():
+    daily = [('Paris', datetime(2001, 2, 1)), ('Belgrade', datetime(2001, 2, 1))]
+    assert IntentParser(CITIES).parse("Which city was colder, Paris or Belgrade on 01-02-2001?") == (daily, None, None)
+    assert IntentParser(CITIES).parse("Which city was warmer, Paris or Belgrade on 01-02-2001?") == (daily, None, None)
+    assert IntentParser(CITIES).parse("Was it colder in Paris on 01-02-2001?") is None
+    assert IntentParser(CITIES).parse("Was Paris colder on 01-02-2001 than on 02-02-2001?") is None
+
+
+def test_comparisons_are_neither_templated_nor_cached():
+    cache = ResponseCache()
+    colder, warmer = plan("Which city was colder, Paris or Belgrade on 01-02-2001?"), plan("Which city was warmer, Paris or Belgrade on 01-02-2001?")
+    assert colder == warmer
+    values = ['3.0', '5.0']
+    assert render_response(colder, values) is None
+    assert cached_response(colder, values, [], "Which city was colder, Paris or Belgrade on 01-02-2001?", cache, True) == (None, None)
+    assert cache.stats() == {'hits': 0, 'misses': 0, 'size': 0}
+
+
+def test_single_lookups_are_templated_and_cached():
+    cache = ResponseCache()
+    requests = plan("What was the temperature in New York on 2001-02-01?")
+    assert render_response(requests, ['4.5']).endswith("The temperature in New York on 01-02-2001 was 4.5°C.")
+    response, key = cached_response(requests, ['4.5'], [], "What was the temperature in New York on 2001-02-01?", cache)
+    assert response is None and key == ResponseCache.key(requests, ['4.5'])